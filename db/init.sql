@@ -10,6 +10,8 @@ CREATE TABLE IF NOT EXISTS policies (
     PRIMARY KEY (client_group, category)
 );
 
+-- ip is a single address ("10.0.0.5") or a CIDR range ("10.0.0.0/24",
+-- "2001:db8::/48"); the most specific match wins.
 CREATE TABLE IF NOT EXISTS clients (
     ip TEXT PRIMARY KEY,
     client_group TEXT
@@ -0,0 +1,105 @@
+import math
+from hashlib import blake2b
+
+# Target false-positive rate of the category filter; every halving costs
+# about 1.44 more bits per domain.
+FP_RATE = 0.01
+
+
+class BloomFilter:
+    # Set membership with false positives but no false negatives, over a
+    # plain byte buffer (a bytearray while building, a slice of the mapped
+    # category index when loaded). Positions come from one 64-bit blake2b
+    # digest split into two 32-bit halves (Kirsch-Mitzenmacher double
+    # hashing), so the bits are the same in every process.
+
+    __slots__ = ("bits", "num_bits", "num_hashes", "count", "min_labels")
+
+    def __init__(self, bits, num_bits, num_hashes, count=0, min_labels=1):
+        self.bits = bits
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        # shortest domain added, in labels; shorter suffixes are not probed
+        self.min_labels = min_labels
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate=FP_RATE):
+        capacity = max(capacity, 1)
+        num_bits = math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2)
+        num_bits = max(num_bits, 64)
+        num_hashes = max(1, round(-math.log2(fp_rate)))
+        return cls(bytearray((num_bits + 7) // 8), num_bits, num_hashes, 0, 0)
+
+    def add(self, item):
+        bits = self.bits
+        num_bits = self.num_bits
+        h = int.from_bytes(blake2b(item, digest_size=8).digest(), "little")
+        bit = h & 0xFFFFFFFF
+        step = (h >> 32) | 1
+        for _ in range(self.num_hashes):
+            bit %= num_bits
+            bits[bit >> 3] |= 1 << (bit & 7)
+            bit += step
+        self.count += 1
+
+    def add_domain(self, domain):
+        domain = domain.rstrip(".")
+        labels = domain.count(".") + 1
+        if not self.min_labels or labels < self.min_labels:
+            self.min_labels = labels
+        self.add(domain.encode())
+
+    def __contains__(self, item):
+        bits = self.bits
+        num_bits = self.num_bits
+        h = int.from_bytes(blake2b(item, digest_size=8).digest(), "little")
+        bit = h & 0xFFFFFFFF
+        step = (h >> 32) | 1
+        for _ in range(self.num_hashes):
+            bit %= num_bits
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+            bit += step
+        return True
+
+    def may_match_suffix(self, domain):
+        # False only if no suffix of domain (www.example.com, example.com,
+        # com) was ever added
+        bits = self.bits
+        num_bits = self.num_bits
+        probes = range(self.num_hashes)
+        data = domain.rstrip(".").encode()
+        start = 0
+        for _ in range(data.count(b".") + 2 - self.min_labels):
+            h = int.from_bytes(
+                blake2b(data[start:], digest_size=8).digest(), "little"
+            )
+            bit = h & 0xFFFFFFFF
+            step = (h >> 32) | 1
+            for _ in probes:
+                bit %= num_bits
+                if not bits[bit >> 3] & (1 << (bit & 7)):
+                    break
+                bit += step
+            else:
+                return True
+            start = data.find(b".", start) + 1
+            if not start:
+                break
+        return False
+
+    def fp_rate(self):
+        # expected rate for the number of items added
+        if not self.count:
+            return 0.0
+        fill = 1 - math.exp(-self.num_hashes * self.count / self.num_bits)
+        return fill ** self.num_hashes
+
+    def stats(self):
+        return {
+            "entries": self.count,
+            "bytes": len(self.bits),
+            "hashes": self.num_hashes,
+            "fp_rate": round(self.fp_rate(), 6),
+        }
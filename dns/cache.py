@@ -1,25 +1,226 @@
+import heapq
 import time
+from collections import OrderedDict
+
+from dns.wire import patch_response, restamp_response
+
+MAX_ENTRIES = 100_000
+MAX_BYTES = 64 * 1024 * 1024
+
+# Rough per-entry cost of the key, entry object and dict slots on top of the
+# response bytes; only used for the max_bytes budget.
+ENTRY_OVERHEAD = 256
+
+# Share of the capacity reserved for entries that were hit at least once.
+# New entries start in the probation segment, so a burst of one-off names
+# (random-subdomain floods) only ever evicts other one-off names.
+PROTECTED_RATIO = 0.8
+
+# Refresh-ahead: an entry hit at least PREFETCH_MIN_HITS times is
+# re-resolved in the background once less than PREFETCH_THRESHOLD of its
+# TTL is left.
+PREFETCH_MIN_HITS = 8
+PREFETCH_THRESHOLD = 0.1
+
+# NXDOMAIN/NODATA answers are cached for their SOA negative TTL, capped
+# like most resolvers do (RFC 2308 section 5).
+MAX_NEGATIVE_TTL = 3600
+
+# Serve-stale (RFC 8767): expired entries are kept this many seconds longer
+# so they can answer when the upstream is slow or down. Stale answers carry
+# STALE_TTL so clients come back soon.
+STALE_WINDOW = 3600
+STALE_TTL = 30
+
+# After a failed refresh, stale answers for that name are served at once,
+# without asking the upstream again, for this many seconds (the failure
+# recheck timer of RFC 8767 section 5).
+FAILURE_RECHECK = 30
+
+# Expired entries removed per set() call, so cleanup cost is spread over
+# normal traffic instead of needing a full scan.
+SWEEP_BATCH = 16
+
+
+class CacheEntry:
+    # Responses are kept in wire format; a hit only rewrites the ID and TTLs.
+    __slots__ = (
+        "data", "ttl_offsets", "stored_at", "expires_at", "size", "hits",
+        "recheck_at",
+    )
+
+    def __init__(self, data, ttl_offsets, stored_at, expires_at):
+        self.data = data
+        self.ttl_offsets = ttl_offsets
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.size = len(data) + ENTRY_OVERHEAD
+        self.hits = 0
+        # no upstream refresh before this time, see FAILURE_RECHECK
+        self.recheck_at = 0.0
+
+    def render(self, txid, now):
+        if now >= self.expires_at:
+            return restamp_response(
+                self.data, self.ttl_offsets, txid, STALE_TTL
+            )
+        return patch_response(
+            self.data, self.ttl_offsets, txid, int(now - self.stored_at)
+        )
+
 
 class DNSCache:
-    def __init__(self):
-        self.store = {}
+    def __init__(
+        self,
+        max_entries=MAX_ENTRIES,
+        max_bytes=MAX_BYTES,
+        stale_window=STALE_WINDOW
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_window = stale_window
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.expiry = []  # heap of (expires_at + stale_window, key)
+        self.bytes = 0
         self.hits = 0
         self.misses = 0
+        self.stale_hits = 0
+        self.negative_stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
 
     def get(self, key, now):
-        if key in self.store:
-            entry = self.store[key]
-            if entry["expires_at"] > now:
-                self.hits += 1
-                return entry["record"]
+        segment = self.protected
+        entry = segment.get(key)
+        if entry is None:
+            segment = self.probation
+            entry = segment.get(key)
+            if entry is None:
+                return None
+
+        if entry.expires_at > now:
+            if segment is self.protected:
+                self.protected.move_to_end(key)
             else:
-                del self.store[key]
+                self._promote(key, entry)
+            self.hits += 1
+            entry.hits += 1
+            return entry
+
+        # expired entries stay around for get_stale() until the window ends
+        if entry.expires_at + self.stale_window <= now:
+            self._remove(key)
+            self.expirations += 1
+
         # Don't increment misses here - do it in server.py
         return None
 
-    def set(self, key, record, ttl, now):
-        if ttl > 0:
-            self.store[key] = {
-                "record": record,
-                "expires_at": now + ttl
-            }
+    def get_stale(self, key, now):
+        entry = self.protected.get(key) or self.probation.get(key)
+        if entry is not None and entry.expires_at + self.stale_window > now:
+            return entry
+        return None
+
+    def refresh_failed(self, key, now):
+        # a successful refresh replaces the entry, and with it this timer
+        entry = self.protected.get(key) or self.probation.get(key)
+        if entry is not None:
+            entry.recheck_at = now + FAILURE_RECHECK
+
+    def set(self, key, data, ttl_offsets, ttl, now, negative=False):
+        if negative:
+            ttl = min(ttl, MAX_NEGATIVE_TTL)
+        if ttl <= 0:
+            return
+
+        if key in self.probation or key in self.protected:
+            self._remove(key)
+
+        entry = CacheEntry(data, ttl_offsets, now, now + ttl)
+        self.probation[key] = entry
+        self.bytes += entry.size
+        if negative:
+            self.negative_stores += 1
+        heapq.heappush(
+            self.expiry, (entry.expires_at + self.stale_window, key)
+        )
+
+        self.sweep(now, SWEEP_BATCH)
+        self._evict()
+
+    def wants_prefetch(self, entry, now):
+        if entry.hits < PREFETCH_MIN_HITS:
+            return False
+        ttl = entry.expires_at - entry.stored_at
+        return entry.expires_at - now < ttl * PREFETCH_THRESHOLD
+
+    def sweep(self, now, limit=None):
+        expiry = self.expiry
+        removed = 0
+
+        while expiry and expiry[0][0] <= now:
+            if limit is not None and removed >= limit:
+                break
+            remove_at, key = heapq.heappop(expiry)
+            entry = self.protected.get(key) or self.probation.get(key)
+            # dead heap item for a key that was replaced or evicted
+            if (
+                entry is None
+                or entry.expires_at + self.stale_window != remove_at
+            ):
+                continue
+            self._remove(key)
+            self.expirations += 1
+            removed += 1
+
+        # replaced and evicted keys leave dead heap items behind
+        if len(expiry) > 2 * len(self) + 1024:
+            self.expiry = [
+                (entry.expires_at + self.stale_window, key)
+                for segment in (self.probation, self.protected)
+                for key, entry in segment.items()
+            ]
+            heapq.heapify(self.expiry)
+
+        return removed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "stale_hits": self.stale_hits,
+            "negative_stores": self.negative_stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _promote(self, key, entry):
+        del self.probation[key]
+        self.protected[key] = entry
+
+        max_protected = int(self.max_entries * PROTECTED_RATIO)
+        while len(self.protected) > max_protected:
+            old_key, old_entry = self.protected.popitem(last=False)
+            self.probation[old_key] = old_entry
+
+    def _remove(self, key):
+        entry = self.protected.pop(key, None)
+        if entry is None:
+            entry = self.probation.pop(key)
+        self.bytes -= entry.size
+        return entry
+
+    def _evict(self):
+        while len(self) > self.max_entries or self.bytes > self.max_bytes:
+            segment = self.probation or self.protected
+            _, entry = segment.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
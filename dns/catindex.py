@@ -0,0 +1,211 @@
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+from dns.bloom import FP_RATE, BloomFilter
+
+# Read-only, memory-mapped form of the category.db domains table, so a
+# worker can start without building a SuffixTrie and all workers share one
+# copy of the data through the page cache.
+#
+#   header | uint32 key offsets (count + 1) | uint16 category ids (count)
+#          | keys | Bloom filter bits | JSON list of category names
+#
+# Keys are domains with their labels reversed and joined by SEP
+# ("www.example.com" -> b"com\0example\0www"), sorted bytewise. SEP sorts
+# below every label byte, so the subdomains of a key directly follow it and
+# a longest-suffix match is one binary search per label, each starting where
+# the previous one ended. Arrays are in native byte order; BYTE_ORDER_MARK
+# rejects an index copied from a machine of the other endianness.
+#
+# The Bloom filter holds every indexed domain, so most uncategorized names
+# are answered by a few hash probes without searching the keys at all.
+
+MAGIC = b"DNSCIDX2"
+HEADER = struct.Struct("=8sIIQQQQII")
+BYTE_ORDER_MARK = 0x01020304
+SEP = b"\0"
+
+# Every FENCE_STRIDE-th key is copied into a list when the index is opened;
+# bisect over that list narrows each search to one block of keys, leaving
+# only a few probes of the mapped file per label.
+FENCE_STRIDE = 64
+
+
+def index_key(domain):
+    return "\0".join(reversed(domain.rstrip(".").split("."))).encode()
+
+
+def build_index(cat_path, index_path, fp_rate=FP_RATE):
+    conn = sqlite3.connect(f"file:{cat_path}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT domain, category FROM domains").fetchall()
+    finally:
+        # close before writing: a WAL checkpoint on close must not make
+        # category.db look newer than the index
+        conn.close()
+
+    categories = []
+    category_ids = {}
+    entries = {}
+    for domain, category in rows:
+        if not domain.rstrip("."):
+            continue
+        cat_id = category_ids.get(category)
+        if cat_id is None:
+            cat_id = category_ids[category] = len(categories)
+            categories.append(category)
+        entries[index_key(domain)] = cat_id
+
+    keys = sorted(entries)
+    keys_offset = HEADER.size + 4 * (len(keys) + 1) + 2 * len(keys)
+
+    bloom = None
+    if fp_rate and keys:
+        bloom = BloomFilter.for_capacity(len(keys), fp_rate)
+        for domain, _ in rows:
+            if domain.rstrip("."):
+                bloom.add_domain(domain)
+    del rows
+
+    # offsets are absolute file positions, so a key is one mmap slice
+    offsets = array("I", [keys_offset])
+    ids = array("H")
+    end = keys_offset
+    for key in keys:
+        end += len(key)
+        offsets.append(end)
+        ids.append(entries[key])
+
+    bloom_offset = end
+    if bloom is not None:
+        end += len(bloom.bits)
+    categories_offset = end
+
+    # written next to the target and renamed over it, so running workers
+    # keep their mapping of the old file until they reload
+    tmp_path = f"{index_path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(
+                MAGIC, BYTE_ORDER_MARK, len(keys), keys_offset,
+                categories_offset, bloom_offset,
+                bloom.num_bits if bloom else 0,
+                bloom.num_hashes if bloom else 0,
+                bloom.min_labels if bloom else 0
+            ))
+            offsets.tofile(f)
+            ids.tofile(f)
+            f.write(b"".join(keys))
+            if bloom is not None:
+                f.write(bloom.bits)
+            f.write(json.dumps(categories).encode())
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return len(keys)
+
+
+def index_is_current(index_path, cat_path):
+    # the index is only used when it was built after the last change to
+    # category.db (including commits still sitting in its WAL file)
+    try:
+        built = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    for path in (cat_path, f"{cat_path}-wal"):
+        try:
+            if os.stat(path).st_mtime_ns > built:
+                return False
+        except FileNotFoundError:
+            pass
+    return True
+
+
+class CategoryIndex:
+    # Same lookup interface as SuffixTrie.
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (
+            magic, mark, count, keys_offset, categories_offset, bloom_offset,
+            bloom_bits, bloom_hashes, bloom_min_labels
+        ) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a category index")
+        if mark != BYTE_ORDER_MARK:
+            raise ValueError(f"{path} was built with a different byte order")
+
+        view = memoryview(self._mmap)
+        ids_offset = HEADER.size + 4 * (count + 1)
+        self._offsets = view[HEADER.size:ids_offset].cast("I")
+        self._ids = view[ids_offset:keys_offset].cast("H")
+        self.categories = [
+            sys.intern(category)
+            for category in json.loads(bytes(view[categories_offset:]))
+        ]
+        self.size = count
+
+        self.filter = None
+        if bloom_bits:
+            self.filter = BloomFilter(
+                view[bloom_offset:categories_offset], bloom_bits,
+                bloom_hashes, count, bloom_min_labels
+            )
+
+        mm = self._mmap
+        offsets = self._offsets
+        self._fences = [
+            mm[offsets[i]:offsets[i + 1]]
+            for i in range(0, count, FENCE_STRIDE)
+        ]
+
+    def __len__(self):
+        return self.size
+
+    def longest_match(self, domain):
+        mm = self._mmap
+        offsets = self._offsets
+        fences = self._fences
+        size = self.size
+        lo = 0
+        best = None
+        prefix = b""
+
+        for label in reversed(domain.rstrip(".").split(".")):
+            key = prefix + label.encode()
+            prefix = key + SEP
+
+            block = bisect_left(fences, key, lo // FENCE_STRIDE)
+            if block:
+                lo = max(lo, (block - 1) * FENCE_STRIDE + 1)
+            hi = min(block * FENCE_STRIDE, size)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if mm[offsets[mid]:offsets[mid + 1]] < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == size:
+                break
+
+            found = mm[offsets[lo]:offsets[lo + 1]]
+            if found == key:
+                best = self._ids[lo]
+                lo += 1
+                if lo == size:
+                    break
+                found = mm[offsets[lo]:offsets[lo + 1]]
+            if not found.startswith(prefix):
+                break  # nothing is listed below this suffix
+
+        return None if best is None else self.categories[best]
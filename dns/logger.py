@@ -1,18 +1,210 @@
+import atexit
 import json
+import os
+import queue
+import random
+import threading
 import time
 from pathlib import Path
 
+from dns.binlog import BinaryLogEncoder
+
 LOG_FILE = Path("logs/dns.log")
+BINARY_LOG_FILE = Path("logs/dns.bin")
+
+# Events waiting for the writer thread; when it is full new events are
+# dropped (and counted) rather than blocking the DNS loop.
+QUEUE_SIZE = 10_000
+
+# The writer flushes after BATCH_SIZE events or FLUSH_INTERVAL seconds,
+# whichever comes first.
+BATCH_SIZE = 512
+FLUSH_INTERVAL = 1.0
+
+# dns.log is rotated to dns.log.1 .. dns.log.N once it reaches MAX_BYTES
+# or every ROTATE_INTERVAL seconds (None disables time-based rotation).
+MAX_BYTES = 50 * 1024 * 1024
+ROTATE_INTERVAL = None
+BACKUP_COUNT = 5
 
 
 class DNSLogger:
-    def __init__(self, log_file=LOG_FILE):
+    def __init__(
+        self,
+        log_file=LOG_FILE,
+        queue_size=QUEUE_SIZE,
+        sample_rate=1.0,
+        max_bytes=MAX_BYTES,
+        rotate_interval=ROTATE_INTERVAL,
+        backup_count=BACKUP_COUNT,
+        log_format="json"
+    ):
         log_file.parent.mkdir(exist_ok=True)
         self.log_file = log_file
+        self.log_format = log_format
+        self.queue_size = queue_size
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.rotations = 0
+
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._rotate_at = None
+        self._encoder = BinaryLogEncoder() if log_format == "binary" else None
+
+        # the writer thread does not survive fork(); workers start their own
+        os.register_at_fork(after_in_child=self._after_fork)
 
     def log(self, event: dict):
-        event["timestamp"] = time.strftime(
-            "%Y-%m-%dT%H:%M:%SZ", time.gmtime()
-        )
-        with open(self.log_file, "a") as f:
-            f.write(json.dumps(event) + "\n")
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+
+        if self._thread is None:
+            self._start()
+
+        try:
+            self._queue.put_nowait((time.time(), event))
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "rotations": self.rotations,
+        }
+
+    def close(self):
+        thread = self._thread
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join()
+        self._thread = None
+
+    def _after_fork(self):
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._file = None
+        if self._encoder is not None:
+            # string ids are per writer, so each worker gets its own file
+            self.log_file = self.log_file.with_name(
+                f"{self.log_file.stem}.{os.getpid()}{self.log_file.suffix}"
+            )
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run,
+                name="dns-logger",
+                daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            batch = []
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= BATCH_SIZE:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    print(f"[ERROR] log write failed: {e}")
+
+            if item is None:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+    def _write(self, batch):
+        f = self._open()
+
+        if self._encoder is not None:
+            encode = self._encoder.encode
+            chunk = b"".join(encode(ts, event) for ts, event in batch)
+        else:
+            lines = []
+            for ts, event in batch:
+                event["timestamp"] = time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(ts)
+                )
+                lines.append(json.dumps(event) + "\n")
+            chunk = "".join(lines).encode()
+
+        f.write(chunk)
+        f.flush()
+        self._size += len(chunk)
+        self.written += len(batch)
+
+        if self._size >= self.max_bytes or (
+            self._rotate_at is not None and time.time() >= self._rotate_at
+        ):
+            self._rotate()
+
+    def _open(self):
+        f = self._file
+        if f is not None:
+            # another worker process may have rotated the file under us
+            try:
+                if os.stat(self.log_file).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+        f = self._file = open(self.log_file, "ab")
+        self._size = os.fstat(f.fileno()).st_size
+        if self._encoder is not None:
+            header = self._encoder.start(new_file=self._size == 0)
+            f.write(header)
+            self._size += len(header)
+        if self.rotate_interval:
+            self._rotate_at = time.time() + self.rotate_interval
+        return f
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+
+        for index in range(self.backup_count - 1, 0, -1):
+            src = f"{self.log_file}.{index}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.log_file}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.log_file, f"{self.log_file}.1")
+        else:
+            os.truncate(self.log_file, 0)
+        self.rotations += 1
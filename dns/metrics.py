@@ -0,0 +1,212 @@
+import math
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Where the Prometheus text endpoint listens; worker N of a --workers setup
+# uses METRICS_PORT + N. Port 0 disables it.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9153
+
+# Upper bounds in seconds of the latency histogram buckets, from a cache hit
+# (tens of microseconds) to an upstream timeout.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class Counter:
+    # Monotonic count per label value. Updated from the DNS loop only; the
+    # scrape thread just reads the ints.
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+        ]
+        for value, count in sorted(self.values.items(), key=_sort_key):
+            pairs = [(self.label, value)] if self.label else []
+            lines.append(f"{self.name}{_labels(pairs)} {_number(count)}")
+        return lines
+
+
+class _Series:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+
+
+class Histogram:
+    # Fixed buckets, so an observation is one bisect and two additions and
+    # p50/p99 are computed by Prometheus (histogram_quantile) at query time.
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, label_value=None):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = _Series(len(self.buckets) + 1)
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for value, series in sorted(self.series.items(), key=_sort_key):
+            base = [(self.label, value)] if self.label else []
+            counts = list(series.counts)
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                pairs = base + [("le", _number(bound))]
+                lines.append(f"{self.name}_bucket{_labels(pairs)} {total}")
+            lines.append(f"{self.name}_sum{_labels(base)} {series.sum!r}")
+            lines.append(f"{self.name}_count{_labels(base)} {total}")
+        return lines
+
+
+def _sort_key(item):
+    return "" if item[0] is None else str(item[0])
+
+
+class MetricsRegistry:
+    def __init__(self, prefix="dns_proxy"):
+        self.prefix = prefix
+        self.metrics = []
+        # name -> (callable returning a stats() dict, label), sampled on
+        # each scrape
+        self.collectors = {}
+
+    def counter(self, name, help, label=None):
+        metric = Counter(f"{self.prefix}_{name}", help, label)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        metric = Histogram(f"{self.prefix}_{name}", help, label, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, name, stats, label=None):
+        # with a label, the top-level keys of the stats() dict are its values,
+        # e.g. {"8.8.8.8:53": {"srtt_ms": 12.5}} under label "upstream" gives
+        # <prefix>_<name>_srtt_ms{upstream="8.8.8.8:53"}
+        self.collectors[name] = (stats, label)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        # the components' own stats() dicts, exported as they are (a mix of
+        # counters and gauges, hence untyped)
+        for name, (stats, label) in list(self.collectors.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                lines.append(f"# {name}: {e!r}")
+                continue
+            if label is None:
+                values = {None: values}
+            families = {}
+            for label_value, entry in values.items():
+                pairs = [(label, label_value)] if label else []
+                for key, value in _flatten(entry):
+                    families.setdefault(key, []).append((pairs, value))
+            for key, series in families.items():
+                metric = f"{self.prefix}_{name}_{key}"
+                lines.append(f"# TYPE {metric} untyped")
+                for pairs, value in series:
+                    lines.append(f"{metric}{_labels(pairs)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(stats, prefix=""):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}_")
+        elif isinstance(value, bool):
+            yield prefix + key, int(value)
+        elif isinstance(value, (int, float)):
+            yield prefix + key, value
+
+
+class MetricsServer:
+    # Serves GET /metrics from a daemon thread so scrapes never run on the
+    # DNS loop.
+
+    def __init__(self, registry, host=METRICS_HOST, port=METRICS_PORT):
+        self.registry = registry
+        self.address = (host, port)
+        self.httpd = None
+        self._thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(self.address, Handler)
+        self.httpd.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever,
+            name="metrics-http",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self.httpd is None:
+            return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+        self.httpd = None
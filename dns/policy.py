@@ -1,13 +1,64 @@
+import os
 import sqlite3
+import time
+from collections import OrderedDict
+
+from dns.catindex import CategoryIndex, index_is_current
+from dns.radix import RadixTree
+from dns.trie import SuffixTrie
 
 DB_PATH = "/app/db/policy.db"
 CAT_PATH = "/app/category_db/category.db"
 
+# Built from category.db by scripts/build_category_index.py (ingest_domains.py
+# rebuilds it too). Used instead of loading the domains table whenever it is
+# at least as new as category.db.
+CAT_INDEX_PATH = "/app/category_db/category.idx"
+
+# Memo of (client_ip, qname) -> (allowed, category) in front of the snapshot
+# lookups. It is cleared whenever a new snapshot generation is loaded, the
+# TTL only bounds how long an idle entry can linger.
+DECISION_CACHE_SIZE = 65_536
+DECISION_TTL = 300.0
+
+
+class PolicySnapshot:
+    # Immutable view of policy.db + category.db; PolicyEngine replaces the
+    # whole object on reload so a query never sees half of an update.
+    __slots__ = ("clients", "policies", "domains", "generation")
+
+    def __init__(self, clients, policies, domains, generation):
+        self.clients = clients
+        self.policies = policies
+        self.domains = domains
+        self.generation = generation
+
 
 class PolicyEngine:
-    def __init__(self, db_path=DB_PATH, cat_path=CAT_PATH):
+    def __init__(
+        self,
+        db_path=DB_PATH,
+        cat_path=CAT_PATH,
+        index_path=CAT_INDEX_PATH,
+        decision_cache_size=DECISION_CACHE_SIZE,
+        decision_ttl=DECISION_TTL
+    ):
         self.db_path = db_path
         self.cat_path = cat_path
+        self.index_path = index_path
+        self.snapshot = None
+        self.generation = 0
+
+        self.decision_cache_size = decision_cache_size
+        self.decision_ttl = decision_ttl
+        self.decisions = OrderedDict()
+        self.decisions_generation = None
+        self.decision_hits = 0
+        self.decision_misses = 0
+        self.filter_skips = 0
+
+        # StageProfiler timing the memo-miss path, set by the server
+        self.profiler = None
 
     def _connect_policy(self):
         return sqlite3.connect(self.db_path)
@@ -15,61 +66,142 @@ class PolicyEngine:
     def _connect_category(self):
         return sqlite3.connect(self.cat_path)
 
-    def get_client_group(self, client_ip):
-        conn = self._connect_policy()
-        cur = conn.cursor()
+    def source_paths(self):
+        return (self.db_path, self.cat_path)
 
-        cur.execute(
-            "SELECT client_group FROM clients WHERE ip=?",
-            (client_ip,)
+    def index_paths(self):
+        return (self.index_path,) if self.index_path else ()
+
+    def _load(self):
+        conn = self._connect_policy()
+        try:
+            # clients.ip holds a single address or a CIDR range
+            clients = RadixTree.from_rows(
+                conn.execute("SELECT ip, client_group FROM clients")
+            )
+            policies = {
+                (client_group, category): bool(allowed)
+                for client_group, category, allowed in conn.execute(
+                    "SELECT client_group, category, allowed FROM policies"
+                )
+            }
+        finally:
+            conn.close()
+
+        return PolicySnapshot(
+            clients, policies, self._load_domains(), self.generation + 1
         )
-        row = cur.fetchone()
-        conn.close()
 
-        return row[0] if row else "default"
+    def _load_domains(self):
+        if self.index_path and index_is_current(self.index_path, self.cat_path):
+            try:
+                return CategoryIndex(self.index_path)
+            except (OSError, ValueError) as e:
+                print(f"[!] Ignoring category index {self.index_path}: {e}")
+        elif self.index_path and os.path.exists(self.index_path):
+            print(
+                f"[!] {self.index_path} is older than {self.cat_path}, "
+                f"loading domains from the database"
+            )
 
-    def get_domain_category(self, domain):
         # NOTE: category lookup must come from category DB, not policy DB
         conn = self._connect_category()
-        cur = conn.cursor()
-
-        # longest suffix match
-        parts = domain.rstrip(".").split(".")
-        for i in range(len(parts)):
-            candidate = ".".join(parts[i:])
-            cur.execute(
-                "SELECT category FROM domains WHERE domain=?",
-                (candidate,)
+        try:
+            return SuffixTrie.from_rows(
+                conn.execute("SELECT domain, category FROM domains")
             )
-            row = cur.fetchone()
-            if row:
-                conn.close()
-                return row[0]
+        finally:
+            conn.close()
+
+    def reload(self):
+        snapshot = self._load()
+        self.generation = snapshot.generation
+        self.snapshot = snapshot
+        return snapshot
+
+    def current(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self.reload()
+        return snapshot
+
+    def get_client_group(self, client_ip):
+        return self.current().clients.get(client_ip, "default")
+
+    def get_domain_category(self, domain):
+        return self._match_category(self.current(), domain)
 
-        conn.close()
-        return "uncategorized"
+    def _match_category(self, snapshot, domain):
+        domains = snapshot.domains
+        bloom = domains.filter
+        if bloom is not None and not bloom.may_match_suffix(domain):
+            self.filter_skips += 1
+            return "uncategorized"
+
+        # longest suffix match
+        category = domains.longest_match(domain)
+        return "uncategorized" if category is None else category
 
     def is_allowed(self, client_ip, domain):
-        client_group = self.get_client_group(client_ip)
-        category = self.get_domain_category(domain)
+        snapshot = self.current()
+        if self.decision_cache_size <= 0:
+            return self._evaluate(snapshot, client_ip, domain)
+
+        decisions = self.decisions
+        if self.decisions_generation != snapshot.generation:
+            decisions.clear()
+            self.decisions_generation = snapshot.generation
+
+        key = (client_ip, domain)
+        now = time.monotonic()
+        entry = decisions.get(key)
+        if entry is not None and entry[2] > now:
+            decisions.move_to_end(key)
+            self.decision_hits += 1
+            return entry[0], entry[1]
+
+        self.decision_misses += 1
+        allowed, category = self._evaluate(snapshot, client_ip, domain)
+        decisions[key] = (allowed, category, now + self.decision_ttl)
+        decisions.move_to_end(key)
+        if len(decisions) > self.decision_cache_size:
+            decisions.popitem(last=False)
+        return allowed, category
+
+    def decision_stats(self):
+        lookups = self.decision_hits + self.decision_misses
+        return {
+            "entries": len(self.decisions),
+            "hits": self.decision_hits,
+            "misses": self.decision_misses,
+            "hit_ratio": self.decision_hits / lookups if lookups else 0.0,
+        }
+
+    def category_stats(self):
+        domains = self.current().domains
+        stats = {
+            "domains": len(domains),
+            "source": "index" if isinstance(domains, CategoryIndex) else "db",
+        }
+        if domains.filter is not None:
+            stats["filter"] = dict(
+                domains.filter.stats(), skipped_lookups=self.filter_skips
+            )
+        return stats
+
+    def _evaluate(self, snapshot, client_ip, domain):
+        profiler = self.profiler
+        if profiler is not None:
+            lap = time.perf_counter()
+        client_group = snapshot.clients.get(client_ip, "default")
+        if profiler is not None:
+            lap = profiler.lap("client_group", lap)
+        category = self._match_category(snapshot, domain)
+        if profiler is not None:
+            profiler.lap("category", lap)
 
         if category == "uncategorized":
             return True, category
 
-        conn = self._connect_policy()
-        cur = conn.cursor()
-
-        cur.execute(
-            """
-            SELECT allowed FROM policies
-            WHERE client_group=? AND category=?
-            """,
-            (client_group, category)
-        )
-        row = cur.fetchone()
-        conn.close()
-
-        if row is None:
-            return True, category  # default allow
-
-        return bool(row[0]), category
+        # default allow
+        return snapshot.policies.get((client_group, category), True), category
@@ -0,0 +1,67 @@
+import time
+
+# Hot-path stages timed by --profile-stages. client_group and category run
+# inside the policy stage, and only when the decision memo misses.
+STAGES = (
+    "parse", "policy", "client_group", "category", "cache", "upstream",
+    "pack", "log",
+)
+
+
+class StageProfiler:
+    # Wall time per query stage, aggregated in-process. Call sites hold it in
+    # a variable that is None when profiling is off, so the disabled cost is
+    # one identity test per stage.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = dict.fromkeys(STAGES, 0)
+        self.totals = dict.fromkeys(STAGES, 0.0)
+        self.max = dict.fromkeys(STAGES, 0.0)
+        self.started = time.time()
+
+    def lap(self, stage, since):
+        # records the time since `since` and returns the new lap start
+        now = time.perf_counter()
+        elapsed = now - since
+        self.counts[stage] += 1
+        self.totals[stage] += elapsed
+        if elapsed > self.max[stage]:
+            self.max[stage] = elapsed
+        return now
+
+    def stats(self):
+        return {
+            stage: {
+                "count": self.counts[stage],
+                "total_s": self.totals[stage],
+                "mean_us": (
+                    self.totals[stage] / self.counts[stage] * 1e6
+                    if self.counts[stage] else 0.0
+                ),
+                "max_us": self.max[stage] * 1e6,
+            }
+            for stage in STAGES
+        }
+
+    def report(self):
+        # excludes the policy sub-stages from the total, they are inside it
+        total = sum(
+            self.totals[stage] for stage in STAGES
+            if stage not in ("client_group", "category")
+        )
+        lines = [
+            f"stage timings over {time.time() - self.started:.0f}s",
+            f"{'stage':<13}{'count':>10}{'total ms':>12}{'mean us':>10}"
+            f"{'max us':>10}{'share':>8}",
+        ]
+        for stage, values in self.stats().items():
+            share = values["total_s"] / total if total else 0.0
+            lines.append(
+                f"{stage:<13}{values['count']:>10}"
+                f"{values['total_s'] * 1000:>12.1f}{values['mean_us']:>10.1f}"
+                f"{values['max_us']:>10.0f}{share:>8.1%}"
+            )
+        return "\n".join(lines)
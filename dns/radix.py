@@ -0,0 +1,94 @@
+import ipaddress
+import socket
+
+V4_MAPPED_PREFIX = b"\x00" * 10 + b"\xff\xff"
+
+
+class _Node:
+    __slots__ = ("zero", "one", "value")
+
+    def __init__(self):
+        self.zero = None
+        self.one = None
+        self.value = None
+
+
+class RadixTree:
+    # Longest-prefix match of client addresses against CIDR ranges, one bit
+    # per level, with separate trees for IPv4 and IPv6. Plain host addresses
+    # are also kept in a dict: they are the longest possible prefix, so
+    # most lookups never walk the tree.
+
+    def __init__(self):
+        self.roots = {4: _Node(), 6: _Node()}
+        self.hosts = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_rows(cls, rows):
+        tree = cls()
+        for network, value in rows:
+            try:
+                tree.insert(network, value)
+            except ValueError as e:
+                print(f"[!] Skipping client entry {network!r}: {e}")
+        return tree
+
+    def insert(self, network, value):
+        net = ipaddress.ip_network(network.strip(), strict=False)
+        self.size += 1
+
+        if net.prefixlen == net.max_prefixlen:
+            self.hosts[str(net.network_address)] = value
+            return
+
+        bits = int(net.network_address)
+        width = net.max_prefixlen
+        node = self.roots[net.version]
+        for shift in range(width - 1, width - 1 - net.prefixlen, -1):
+            if (bits >> shift) & 1:
+                if node.one is None:
+                    node.one = _Node()
+                node = node.one
+            else:
+                if node.zero is None:
+                    node.zero = _Node()
+                node = node.zero
+        node.value = value
+
+    def get(self, address, default=None):
+        value = self.hosts.get(address)
+        if value is not None:
+            return value
+
+        # inet_pton is much cheaper than building an ipaddress object
+        try:
+            packed = socket.inet_pton(socket.AF_INET, address)
+        except OSError:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6, address)
+            except OSError:
+                return default
+            if packed.startswith(V4_MAPPED_PREFIX):
+                packed = packed[12:]
+                value = self.hosts.get(socket.inet_ntop(socket.AF_INET, packed))
+                if value is not None:
+                    return value
+
+        bits = int.from_bytes(packed, "big")
+        width = len(packed) * 8
+        node = self.roots[4 if width == 32 else 6]
+        best = None
+        shift = width - 1
+        while node is not None:
+            if node.value is not None:
+                best = node.value
+            if shift < 0:
+                break
+            node = node.one if (bits >> shift) & 1 else node.zero
+            shift -= 1
+
+        return default if best is None else best
@@ -0,0 +1,95 @@
+import socket
+from collections import OrderedDict
+
+# Per-client limiting (off unless --rate-limit is given): clients are keyed
+# by address, or by subnet when these prefixes are shorter than the address.
+RATE_LIMIT_V4_PREFIX = 32
+RATE_LIMIT_V6_PREFIX = 56
+
+# Buckets kept at most; the least recently seen client is evicted first and
+# starts again with a full burst when it comes back.
+CLIENT_TABLE_SIZE = 50_000
+
+# What an over-budget query gets: nothing, a REFUSED answer, or an empty
+# answer with TC set, which spoofed sources cannot follow up over TCP.
+RATE_LIMIT_ACTIONS = ("drop", "refused", "truncate")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now, cost=1.0):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        self.tokens = tokens if tokens < self.burst else self.burst
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class ClientRateLimiter:
+    # One token bucket per client address or subnet, in an LRU table so
+    # memory stays bounded however many sources show up.
+
+    def __init__(
+        self,
+        rate,
+        burst,
+        action="drop",
+        table_size=CLIENT_TABLE_SIZE,
+        v4_prefix=RATE_LIMIT_V4_PREFIX,
+        v6_prefix=RATE_LIMIT_V6_PREFIX
+    ):
+        if action not in RATE_LIMIT_ACTIONS:
+            raise ValueError(f"unknown rate limit action {action!r}")
+        self.rate = rate
+        self.burst = burst
+        self.action = action
+        self.table_size = table_size
+        self.v4_shift = 32 - v4_prefix
+        self.v6_shift = 128 - v6_prefix
+        self.buckets = OrderedDict()
+        self.limited = 0
+        self.evictions = 0
+
+    def key(self, ip):
+        if ":" in ip:
+            if not self.v6_shift:
+                return ip
+            packed = socket.inet_pton(socket.AF_INET6, ip)
+            return 6, int.from_bytes(packed, "big") >> self.v6_shift
+        if not self.v4_shift:
+            return ip
+        packed = socket.inet_aton(ip)
+        return 4, int.from_bytes(packed, "big") >> self.v4_shift
+
+    def allow(self, ip, now):
+        key = self.key(ip)
+        buckets = self.buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(self.rate, self.burst, now)
+            if len(buckets) > self.table_size:
+                buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            buckets.move_to_end(key)
+
+        if bucket.take(now):
+            return True
+        self.limited += 1
+        return False
+
+    def stats(self):
+        return {
+            "clients": len(self.buckets),
+            "limited": self.limited,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,123 @@
+import os
+import sqlite3
+import threading
+import time
+
+# How often policy.db/category.db (and the category index) are checked for
+# changes.
+RELOAD_INTERVAL = 2.0
+
+
+class PolicyReloader:
+    # Watches the policy and category databases from a background thread and
+    # rebuilds the PolicyEngine snapshot when they change. A commit from any
+    # other connection (e.g. the dashboard's /policy POST) bumps
+    # PRAGMA data_version on our long-lived read-only connection; a file
+    # replaced on disk shows up as a new inode or mtime.
+
+    def __init__(self, engine, interval=RELOAD_INTERVAL):
+        self.engine = engine
+        self.interval = interval
+        self.reloads = 0
+        self.failures = 0
+        self.last_duration_ms = None
+        self.last_reload_at = None
+        self._connections = {}
+        self._fingerprint = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._fingerprint = self._take_fingerprint()
+        self.engine.current()
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name="policy-reloader",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for _, conn in self._connections.values():
+            conn.close()
+        self._connections = {}
+
+    def stats(self):
+        return {
+            "generation": self.engine.generation,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_duration_ms": self.last_duration_ms,
+            "last_reload_at": self.last_reload_at,
+        }
+
+    def check(self):
+        fingerprint = self._take_fingerprint()
+        if fingerprint == self._fingerprint:
+            return False
+
+        start = time.perf_counter()
+        try:
+            self.engine.reload()
+        except Exception as e:
+            # keep serving the previous snapshot; retry on the next change
+            self.failures += 1
+            print(f"[ERROR] policy reload failed: {e}", flush=True)
+            return False
+
+        self._fingerprint = fingerprint
+        self.reloads += 1
+        self.last_duration_ms = round((time.perf_counter() - start) * 1000, 2)
+        self.last_reload_at = time.time()
+        print(
+            f"[+] Policy snapshot reloaded (generation "
+            f"{self.engine.generation}, {self.last_duration_ms} ms)",
+            flush=True
+        )
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"[ERROR] policy change check failed: {e}", flush=True)
+
+    def _take_fingerprint(self):
+        fingerprint = []
+        for path in self.engine.source_paths():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                fingerprint.append(None)
+                continue
+
+            inode = (st.st_dev, st.st_ino)
+            known = self._connections.get(path)
+            if known is None or known[0] != inode:
+                if known is not None:
+                    known[1].close()
+                conn = sqlite3.connect(
+                    f"file:{path}?mode=ro",
+                    uri=True,
+                    check_same_thread=False
+                )
+                known = self._connections[path] = (inode, conn)
+
+            data_version = known[1].execute("PRAGMA data_version").fetchone()[0]
+            fingerprint.append((inode, st.st_mtime_ns, data_version))
+
+        # index files are replaced whole by their build step
+        for path in self.engine.index_paths():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                fingerprint.append(None)
+                continue
+            fingerprint.append((st.st_dev, st.st_ino, st.st_mtime_ns))
+        return tuple(fingerprint)
@@ -1,29 +1,257 @@
+import asyncio
+import signal
 import socket
 import time
 import sys
+from collections import deque
 from dnslib import DNSRecord, DNSHeader, QTYPE, RCODE
 from dns.cache import DNSCache
 from dns.policy import PolicyEngine
-from dns.logger import DNSLogger
+from dns.profiling import StageProfiler
+from dns.logger import BINARY_LOG_FILE, LOG_FILE, DNSLogger
+from dns.metrics import (
+    METRICS_HOST,
+    METRICS_PORT,
+    MetricsRegistry,
+    MetricsServer,
+)
+from dns.ratelimit import ClientRateLimiter, TokenBucket
+from dns.reload import PolicyReloader
+from dns.upstream import BlockingUpstream, SingleFlight, UpstreamSet
+from dns.wire import (
+    MIN_UDP_PAYLOAD,
+    Question,
+    error_response,
+    parse_question,
+    scan_ttls,
+    truncate_response,
+    udp_payload_size,
+)
 
-UPSTREAM_DNS = ("8.8.8.8", 53)
+UPSTREAM_SERVERS = [("8.8.8.8", 53)]
 LISTEN_ADDR = ("0.0.0.0", 53)
+# Total time a miss may spend on the upstreams, retries included; each try
+# gets a shorter timeout adapted to its server's RTT (see dns/upstream.py).
+UPSTREAM_TIMEOUT = 5.0
+
+# Send each miss to the two fastest upstreams at once and take the first
+# answer (async mode).
+UPSTREAM_RACE = False
+
+# Queries handled concurrently by the asyncio server; datagrams arriving
+# above this limit are dropped so queueing delay cannot grow without bound.
+MAX_INFLIGHT = 1024
+
+# TCP clients (mostly retries of truncated UDP answers) in async mode:
+# connections served at once, queries in flight per connection, and seconds
+# a connection may sit idle (RFC 7766 section 6.2.3).
+MAX_TCP_CONNECTIONS = 256
+TCP_PIPELINE = 32
+TCP_IDLE_TIMEOUT = 10.0
+
+# With a stale entry at hand, a miss waits this long for the upstream
+# before answering stale (RFC 8767 client response timer).
+STALE_ANSWER_TIMEOUT = 1.8
+
+# Background refreshes of hot cache entries allowed per second (0 disables
+# prefetching), so refresh-ahead cannot flood the upstream.
+PREFETCH_RATE = 50
 
 policy_engine = PolicyEngine()
+policy_reloader = PolicyReloader(policy_engine)
 logger = DNSLogger()
 
 cache = DNSCache()
 
+metrics = MetricsRegistry()
+query_duration = metrics.histogram(
+    "query_duration_seconds",
+    "Time from receiving a query to sending its answer.",
+    label="result"
+)
+policy_duration = metrics.histogram(
+    "policy_duration_seconds",
+    "Time spent deciding whether a query is allowed."
+)
+upstream_rtt = metrics.histogram(
+    "upstream_rtt_seconds",
+    "Round-trip time of answered upstream queries."
+)
+upstream_failures = metrics.counter(
+    "upstream_failures_total",
+    "Upstream queries that timed out or failed.",
+    label="reason"
+)
+query_errors = metrics.counter(
+    "query_errors_total",
+    "Queries that ended in an exception."
+)
+rate_limited = metrics.counter(
+    "rate_limited_total",
+    "Queries over their client's rate limit, by the action taken.",
+    label="action"
+)
+# per-stage timings of the asyncio path, None unless --profile-stages
+profiler = None
+# per-client token buckets, None unless --rate-limit
+rate_limiter = None
+
+# looked up on every scrape: configure_logging() replaces the logger
+metrics.add_collector("cache", lambda: cache.stats())
+metrics.add_collector("log", lambda: logger.stats())
+metrics.add_collector("decisions", lambda: policy_engine.decision_stats())
+metrics.add_collector("categories", lambda: policy_engine.category_stats())
+metrics.add_collector("reload", lambda: policy_reloader.stats())
+
+
+def block_reply(request, rcode=RCODE.NXDOMAIN):
+    return DNSRecord(
+        DNSHeader(id=request.header.id, qr=1, aa=1, ra=1, rcode=rcode),
+        q=request.q
+    )
+
+
+def decode_query(data):
+    question = parse_question(data)
+    if question is not None:
+        return question
+
+    # malformed or unusual packets go through dnslib
+    request = DNSRecord.parse(data)
+    return Question(
+        str(request.q.qname).lower(),
+        request.q.qtype,
+        request.q.qclass,
+        None
+    )
+
+
+def error_reply(data, question, rcode):
+    if question.end is not None:
+        return error_response(data, question.end, rcode)
+    return block_reply(DNSRecord.parse(data), rcode).pack()
+
+
+def fit_udp(reply, query):
+    # answers larger than the client takes over UDP go out truncated with
+    # TC set, so the client asks again over TCP
+    if len(reply) > MIN_UDP_PAYLOAD and len(reply) > udp_payload_size(query):
+        return truncate_response(reply)
+    return reply
+
+
+def rate_limited_reply(data, tcp=False):
+    # the answer to a query over its client's budget, None to drop it
+    action = rate_limiter.action
+    if action == "truncate" and tcp:
+        action = "refused"  # TC means nothing over TCP
+    rate_limited.inc(action)
+    if action == "drop":
+        return None
+    try:
+        question = decode_query(data)
+    except Exception:
+        return None
+    if action == "refused":
+        return error_reply(data, question, RCODE.REFUSED)
+    return truncate_response(error_reply(data, question, RCODE.NOERROR))
+
+
+def configure_cache(max_entries, max_bytes, stale_window):
+    cache.max_entries = max_entries
+    cache.max_bytes = max_bytes
+    cache.stale_window = stale_window
+
+
+def configure_network(listen_addr, upstreams, race=False):
+    global LISTEN_ADDR, UPSTREAM_SERVERS, UPSTREAM_RACE
+    LISTEN_ADDR = listen_addr
+    UPSTREAM_SERVERS = list(upstreams)
+    UPSTREAM_RACE = race
+
+
+def configure_policy(db_path, cat_path, index_path):
+    global policy_engine, policy_reloader
+    policy_engine = PolicyEngine(db_path, cat_path, index_path)
+    policy_engine.profiler = profiler
+    policy_reloader = PolicyReloader(policy_engine)
+
+
+def configure_rate_limit(rate, burst, action, v4_prefix, v6_prefix):
+    global rate_limiter
+    if rate <= 0:
+        rate_limiter = None
+        metrics.collectors.pop("ratelimit", None)
+        return
+    rate_limiter = ClientRateLimiter(
+        rate,
+        burst or max(2 * rate, 1),
+        action,
+        v4_prefix=v4_prefix,
+        v6_prefix=v6_prefix
+    )
+    metrics.add_collector("ratelimit", rate_limiter.stats)
+
+
+def configure_profiling(enabled):
+    global profiler
+    profiler = StageProfiler() if enabled else None
+    policy_engine.profiler = profiler
+    if profiler is None:
+        metrics.collectors.pop("stages", None)
+        return
+
+    metrics.add_collector("stages", lambda: profiler.stats())
+    signal.signal(signal.SIGUSR1, print_stages)
+
+
+def print_stages(signum=None, frame=None):
+    # kill -USR1 <pid> prints the table of the process (or worker) signalled
+    if profiler is not None:
+        print(profiler.report(), flush=True)
+
+
+def configure_logging(sample_rate, log_format="json"):
+    global logger
+    logger = DNSLogger(
+        BINARY_LOG_FILE if log_format == "binary" else LOG_FILE,
+        sample_rate=sample_rate,
+        log_format=log_format
+    )
+
+
+def load_policy():
+    return policy_engine.current()
+
+
+def start_metrics(host=METRICS_HOST, port=METRICS_PORT):
+    server = MetricsServer(metrics, host, port)
+    try:
+        server.start()
+    except OSError as e:
+        # metrics are optional, never a reason not to serve DNS
+        print(f"[ERROR] metrics endpoint {host}:{port}: {e}", flush=True)
+        return None
+    print(f"[+] Metrics on http://{host}:{port}/metrics", flush=True)
+    return server
+
 
-def extract_ttl(dns_response):
-    if not dns_response.rr:
-        return 0
-    return min(rr.ttl for rr in dns_response.rr)
+def check_policy(client_ip, qname):
+    started = time.perf_counter()
+    decision = policy_engine.is_allowed(client_ip, qname)
+    policy_duration.observe(time.perf_counter() - started)
+    return decision
 
 
-def run_dns_server():
+def run_dns_server(reuse_port=False):
+    policy_reloader.start()
+    upstream = BlockingUpstream(UPSTREAM_SERVERS)
+    metrics.add_collector("upstream", upstream.stats, label="upstream")
+
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.settimeout(None)  # Keep blocking behavior but handle errors
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind(LISTEN_ADDR)
 
     # print(f"[+] DNS Proxy listening on {LISTEN_ADDR[0]}:{LISTEN_ADDR[1]}")
@@ -38,9 +266,17 @@ def run_dns_server():
         now = time.time()
 
         try:
-            request = DNSRecord.parse(data)
-            qname = str(request.q.qname).lower()
-            qtype = QTYPE[request.q.qtype]
+            if rate_limiter is not None and not rate_limiter.allow(
+                client_addr[0], time.monotonic()
+            ):
+                reply = rate_limited_reply(data)
+                if reply is not None:
+                    sock.sendto(reply, client_addr)
+                continue
+
+            question = decode_query(data)
+            qname = question.qname
+            qtype = QTYPE[question.qtype]
             cache_key = (qname, qtype)
 
             # print(f"[QUERY] {client_addr[0]} → {qname} ({qtype})")
@@ -51,18 +287,11 @@ def run_dns_server():
                 "qtype": qtype
             }
 
-            
-            allowed, category = policy_engine.is_allowed(
-                client_addr[0],
-                qname
-            )
+            allowed, category = check_policy(client_addr[0], qname)
 
             if not allowed:
-                reply = DNSRecord(
-                    DNSHeader(id=request.header.id, qr=1, aa=1, ra=1, rcode=RCODE.NXDOMAIN),
-                    q = request.q
-                )
-                sock.sendto(reply.pack(), client_addr)
+                sock.sendto(error_reply(data, question, RCODE.NXDOMAIN), client_addr)
+                query_duration.observe(time.time() - start, "block")
                 # print(
                 #     f"[POLICY BLOCK] client={client_addr[0]} "
                 #     f"domain={qname} category={category}"
@@ -80,9 +309,12 @@ def run_dns_server():
             # CACHE LOOKUP
             cached = cache.get(cache_key, now)
             if cached:
-                cached.header.id = request.header.id
-                sock.sendto(cached.pack(), client_addr)
-                latency = (time.time() - start) * 1000
+                sock.sendto(
+                    fit_udp(cached.render(data[:2], now), data),
+                    client_addr
+                )
+                elapsed = time.time() - start
+                query_duration.observe(elapsed, "hit")
                 # print(
                 #     f"[CACHE HIT] {qname} | {latency:.2f} ms "
                 #     f"(hits={cache.hits}, misses={cache.misses})"
@@ -92,29 +324,67 @@ def run_dns_server():
                     "category": category,
                     "decision":"ALLOW",
                     "cache":"HIT",
-                    "latency_ms":round(
-                        (time.time()-start)*1000, 2
-                    )
+                    "latency_ms":round(elapsed * 1000, 2)
                 })
                 continue
 
             # CACHE MISS
             cache.misses += 1
 
-            # UPSTREAM QUERY
-            upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            upstream.settimeout(5.0)  # Add timeout
-            upstream.sendto(data, UPSTREAM_DNS)
-            response_data, _ = upstream.recvfrom(4096)
-            upstream.close()  # Close the socket
+            # UPSTREAM QUERY, skipped while a failed refresh of the stale
+            # entry waits for its recheck timer; with a stale entry at hand
+            # it only gets the client response timer
+            stale = cache.get_stale(cache_key, now)
+            response_data = None
+            if stale is None or stale.recheck_at <= now:
+                sent = time.perf_counter()
+                try:
+                    response_data = upstream.query(
+                        data,
+                        question.end,
+                        UPSTREAM_TIMEOUT if stale is None
+                        else STALE_ANSWER_TIMEOUT
+                    )
+                except OSError as e:
+                    upstream_failures.inc(
+                        "timeout" if isinstance(e, socket.timeout) else "error"
+                    )
+                    cache.refresh_failed(cache_key, time.time())
+                    if stale is None:
+                        sock.sendto(
+                            error_reply(data, question, RCODE.SERVFAIL),
+                            client_addr
+                        )
+                        query_duration.observe(
+                            time.time() - start, "servfail"
+                        )
+                        raise
+
+            if response_data is None:
+                cache.stale_hits += 1
+                sock.sendto(
+                    fit_udp(stale.render(data[:2], time.time()), data),
+                    client_addr
+                )
+                elapsed = time.time() - start
+                query_duration.observe(elapsed, "stale")
+                logger.log({
+                    **base_event,
+                    "category": category,
+                    "decision": "ALLOW",
+                    "cache": "STALE",
+                    "latency_ms": round(elapsed * 1000, 2)
+                })
+                continue
+            upstream_rtt.observe(time.perf_counter() - sent)
 
-            response = DNSRecord.parse(response_data)
-            ttl = extract_ttl(response)
+            ttl_offsets, ttl, negative = scan_ttls(response_data)
 
-            cache.set(cache_key, response, ttl, now)
+            cache.set(cache_key, response_data, ttl_offsets, ttl, now, negative)
 
-            sock.sendto(response_data, client_addr)
-            latency = (time.time() - start) * 1000
+            sock.sendto(fit_udp(response_data, data), client_addr)
+            elapsed = time.time() - start
+            query_duration.observe(elapsed, "miss")
             # print(
             #     f"[CACHE MISS] {qname} | {latency:.2f} ms "
             #     f"(hits={cache.hits}, misses={cache.misses}, ttl={ttl})"
@@ -125,10 +395,421 @@ def run_dns_server():
                 "category": category,
                 "decision": "ALLOW",
                 "cache":"MISS",
-                "latency_ms":round(
-                    (time.time()-start)*1000, 2
-                )
+                "latency_ms":round(elapsed * 1000, 2)
             })
 
         except Exception as e:
+            query_errors.inc()
             print(f"[ERROR] {e}")
+
+
+class DNSServerProtocol(asyncio.DatagramProtocol):
+    def __init__(
+        self,
+        upstream,
+        max_inflight=MAX_INFLIGHT,
+        prefetch_rate=PREFETCH_RATE
+    ):
+        self.upstream = upstream
+        self.singleflight = SingleFlight()
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.dropped = 0
+        self.tasks = set()
+        self.transport = None
+        self.prefetch_budget = TokenBucket(
+            prefetch_rate,
+            max(prefetch_rate, 1) if prefetch_rate > 0 else 0,
+            time.monotonic()
+        )
+        self.prefetches = 0
+        self.prefetches_skipped = 0
+        self.truncated = 0
+        self.tcp_connections = 0
+        self.tcp_refused = 0
+        self.tcp_queries = 0
+        self.tcp_waits = 0
+        # TCP handlers waiting for an in-flight slot
+        self.slot_waiters = deque()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, client_addr):
+        # shed over-budget clients before they cost a task
+        if rate_limiter is not None and not rate_limiter.allow(
+            client_addr[0], time.monotonic()
+        ):
+            reply = rate_limited_reply(data)
+            if reply is not None:
+                self.transport.sendto(reply, client_addr)
+            return
+        if self.inflight >= self.max_inflight:
+            self.dropped += 1
+            return
+        self.submit(data, client_addr, self.udp_sender(data, client_addr))
+
+    def submit(self, data, client_addr, send):
+        self.inflight += 1
+        task = asyncio.ensure_future(
+            self.handle_query(data, client_addr, send)
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self._query_done)
+        return task
+
+    def udp_sender(self, data, client_addr):
+        def send(reply):
+            fitted = fit_udp(reply, data)
+            if fitted is not reply:
+                self.truncated += 1
+            self.transport.sendto(fitted, client_addr)
+        return send
+
+    async def serve_tcp(self, reader, writer):
+        # length-prefixed queries, answered as they complete, so one slow
+        # miss does not hold up the pipelined queries behind it
+        if self.tcp_connections >= MAX_TCP_CONNECTIONS:
+            self.tcp_refused += 1
+            writer.close()
+            return
+
+        self.tcp_connections += 1
+        client_addr = writer.get_extra_info("peername")
+        slots = asyncio.Semaphore(TCP_PIPELINE)
+        pending = set()
+
+        def send(reply):
+            if not writer.is_closing():
+                writer.write(len(reply).to_bytes(2, "big") + reply)
+
+        def done(task):
+            pending.discard(task)
+            slots.release()
+
+        try:
+            while True:
+                # a client that sends but does not read gets no more
+                # queries in until its answers drain, and is dropped if
+                # they stay stuck
+                try:
+                    await asyncio.wait_for(writer.drain(), TCP_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    writer.transport.abort()
+                    break
+                except OSError:
+                    break
+                try:
+                    length = await asyncio.wait_for(
+                        reader.readexactly(2),
+                        TCP_IDLE_TIMEOUT
+                    )
+                    data = await asyncio.wait_for(
+                        reader.readexactly(int.from_bytes(length, "big")),
+                        TCP_IDLE_TIMEOUT
+                    )
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        OSError):
+                    break
+                if rate_limiter is not None and not rate_limiter.allow(
+                    client_addr[0], time.monotonic()
+                ):
+                    reply = rate_limited_reply(data, tcp=True)
+                    if reply is not None:
+                        send(reply)
+                    continue
+                await slots.acquire()
+                if self.inflight >= self.max_inflight:
+                    self.tcp_waits += 1
+                    await self.wait_for_slot()
+                self.tcp_queries += 1
+                task = self.submit(data, client_addr, send)
+                pending.add(task)
+                task.add_done_callback(done)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            self.tcp_connections -= 1
+            writer.close()
+
+    def _query_done(self, task):
+        self.tasks.discard(task)
+        self.inflight -= 1
+        while self.slot_waiters:
+            waiter = self.slot_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def wait_for_slot(self):
+        # TCP queries count against max_inflight like datagrams, but wait
+        # for a slot (and stop reading their connection) instead of being
+        # dropped
+        while self.inflight >= self.max_inflight:
+            waiter = asyncio.get_running_loop().create_future()
+            self.slot_waiters.append(waiter)
+            await waiter
+
+    def prefetch(self, data, question, cache_key):
+        if cache_key in self.singleflight.pending:
+            return
+        if not self.prefetch_budget.take(time.monotonic()):
+            self.prefetches_skipped += 1
+            return
+
+        self.prefetches += 1
+        task = asyncio.ensure_future(self.singleflight.run(
+            cache_key,
+            lambda: self.resolve(data, question, cache_key)
+        ))
+        self.run_in_background(task)
+
+    def run_in_background(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[ERROR] background refresh failed: {task.exception()!r}")
+
+    def stats(self):
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "dropped": self.dropped,
+            "background_tasks": len(self.tasks) - self.inflight,
+            "prefetches": self.prefetches,
+            "prefetches_skipped": self.prefetches_skipped,
+            "singleflight": self.singleflight.stats(),
+            "upstream_queries": self.upstream.queries,
+            "upstream_timeouts": self.upstream.timeouts,
+            "upstream_retries": self.upstream.retries,
+            "upstream_tcp_fallbacks": self.upstream.tcp_fallbacks,
+            "truncated": self.truncated,
+            "tcp_connections": self.tcp_connections,
+            "tcp_refused": self.tcp_refused,
+            "tcp_queries": self.tcp_queries,
+            "tcp_waits": self.tcp_waits,
+        }
+
+    async def resolve(self, data, question, cache_key):
+        sent = time.perf_counter()
+        try:
+            response_data = await self.upstream.query(
+                data,
+                question.end,
+                UPSTREAM_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            upstream_failures.inc("timeout")
+            cache.refresh_failed(cache_key, time.time())
+            raise
+        except OSError:
+            upstream_failures.inc("error")
+            cache.refresh_failed(cache_key, time.time())
+            raise
+        upstream_rtt.observe(time.perf_counter() - sent)
+        if profiler is not None:
+            profiler.lap("upstream", sent)
+
+        ttl_offsets, ttl, negative = scan_ttls(response_data)
+        cache.set(
+            cache_key,
+            response_data,
+            ttl_offsets,
+            ttl,
+            time.time(),
+            negative
+        )
+        return response_data
+
+    def answer_stale(self, stale, data, send, start, event):
+        cache.stale_hits += 1
+        send(stale.render(data[:2], time.time()))
+        elapsed = time.time() - start
+        query_duration.observe(elapsed, "stale")
+        self.log({
+            **event,
+            "decision": "ALLOW",
+            "cache": "STALE",
+            "latency_ms": round(elapsed * 1000, 2)
+        })
+
+    def log(self, event):
+        prof = profiler
+        if prof is None:
+            logger.log(event)
+            return
+        lap = time.perf_counter()
+        logger.log(event)
+        prof.lap("log", lap)
+
+    async def handle_query(self, data, client_addr, send):
+        start = time.time()
+        now = time.time()
+        prof = profiler
+        if prof is not None:
+            lap = time.perf_counter()
+
+        try:
+            question = decode_query(data)
+            if prof is not None:
+                lap = prof.lap("parse", lap)
+            qname = question.qname
+            qtype = QTYPE[question.qtype]
+            cache_key = (qname, qtype)
+
+            base_event = {
+                "client_ip": client_addr[0],
+                "domain": qname,
+                "qtype": qtype
+            }
+
+            allowed, category = check_policy(client_addr[0], qname)
+            if prof is not None:
+                lap = prof.lap("policy", lap)
+
+            if not allowed:
+                reply = error_reply(data, question, RCODE.NXDOMAIN)
+                if prof is not None:
+                    prof.lap("pack", lap)
+                send(reply)
+                query_duration.observe(time.time() - start, "block")
+                self.log({
+                    **base_event,
+                    "category": category,
+                    "decision": "BLOCK",
+                    "reason": "policy_denied",
+                    "cache": "NA",
+                    "latency_ms": 0
+                })
+                return
+
+            cached = cache.get(cache_key, now)
+            if prof is not None:
+                lap = prof.lap("cache", lap)
+            if cached:
+                reply = cached.render(data[:2], now)
+                if prof is not None:
+                    prof.lap("pack", lap)
+                send(reply)
+                elapsed = time.time() - start
+                query_duration.observe(elapsed, "hit")
+                if cache.wants_prefetch(cached, now):
+                    self.prefetch(data, question, cache_key)
+                self.log({
+                    **base_event,
+                    "category": category,
+                    "decision": "ALLOW",
+                    "cache": "HIT",
+                    "latency_ms": round(elapsed * 1000, 2)
+                })
+                return
+
+            cache.misses += 1
+
+            stale = cache.get_stale(cache_key, now)
+            if stale is not None and stale.recheck_at > now:
+                # the last refresh failed; leave the upstream alone until
+                # the recheck timer runs out
+                self.answer_stale(stale, data, send, start, {
+                    **base_event,
+                    "category": category,
+                })
+                return
+
+            lookup = self.singleflight.run(
+                cache_key,
+                lambda: self.resolve(data, question, cache_key)
+            )
+            try:
+                if stale is None:
+                    response_data, leader = await lookup
+                else:
+                    lookup = asyncio.ensure_future(lookup)
+                    response_data, leader = await asyncio.wait_for(
+                        asyncio.shield(lookup),
+                        STALE_ANSWER_TIMEOUT
+                    )
+            except (asyncio.TimeoutError, OSError):
+                if stale is None:
+                    send(error_reply(data, question, RCODE.SERVFAIL))
+                    query_duration.observe(time.time() - start, "servfail")
+                    raise
+
+                # answer stale now, let the lookup refresh the cache later;
+                # until it does, later queries get the stale answer at once
+                if not lookup.done():
+                    self.run_in_background(lookup)
+                cache.refresh_failed(cache_key, time.time())
+                self.answer_stale(stale, data, send, start, {
+                    **base_event,
+                    "category": category,
+                })
+                return
+
+            if prof is not None:
+                lap = time.perf_counter()
+            reply = data[:2] + response_data[2:]
+            if prof is not None:
+                prof.lap("pack", lap)
+            send(reply)
+            elapsed = time.time() - start
+            query_duration.observe(elapsed, "miss" if leader else "coalesced")
+            self.log({
+                **base_event,
+                "category": category,
+                "decision": "ALLOW",
+                "cache": "MISS" if leader else "COALESCED",
+                "latency_ms": round(elapsed * 1000, 2)
+            })
+
+        except Exception as e:
+            query_errors.inc()
+            print(f"[ERROR] {e!r}")
+
+
+async def serve_async(
+    max_inflight=MAX_INFLIGHT,
+    reuse_port=False,
+    prefetch_rate=PREFETCH_RATE
+):
+    loop = asyncio.get_running_loop()
+    policy_reloader.start()
+    upstream = UpstreamSet(UPSTREAM_SERVERS, race=UPSTREAM_RACE)
+    metrics.add_collector("upstream", upstream.stats, label="upstream")
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: DNSServerProtocol(upstream, max_inflight, prefetch_rate),
+        local_addr=LISTEN_ADDR,
+        reuse_port=reuse_port or None
+    )
+    tcp_server = await asyncio.start_server(
+        protocol.serve_tcp,
+        LISTEN_ADDR[0],
+        LISTEN_ADDR[1],
+        reuse_port=reuse_port or None
+    )
+    metrics.add_collector("server", protocol.stats)
+
+    print(
+        f"[+] DNS Proxy (asyncio, max_inflight={max_inflight}) listening on "
+        f"{LISTEN_ADDR[0]}:{LISTEN_ADDR[1]} (UDP and TCP)",
+        flush=True
+    )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        policy_reloader.stop()
+        tcp_server.close()
+        transport.close()
+        upstream.close()
+
+
+def run_async_dns_server(
+    max_inflight=MAX_INFLIGHT,
+    reuse_port=False,
+    prefetch_rate=PREFETCH_RATE
+):
+    asyncio.run(serve_async(max_inflight, reuse_port, prefetch_rate))
@@ -0,0 +1,100 @@
+import sys
+
+
+class _Node:
+    __slots__ = ("children", "category")
+
+    def __init__(self, category=None):
+        self.children = None
+        self.category = category
+
+
+class SuffixTrie:
+    # Domains are stored label by label from the TLD down ("com" ->
+    # "facebook"), so a longest-suffix match is a single walk whose cost
+    # depends on the number of labels in the query only.
+    #
+    # To keep multi-million entry blocklists small, a domain that has no
+    # subdomains below it is stored as a bare category id in its parent's
+    # children dict instead of a _Node; it becomes a node only once
+    # something is inserted underneath it. Labels are interned and
+    # categories are kept once in self.categories.
+
+    # a miss already costs only a dict lookup or two, no pre-check needed
+    filter = None
+
+    def __init__(self):
+        self.root = _Node()
+        self.categories = []
+        self._category_ids = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_rows(cls, rows):
+        trie = cls()
+        for domain, category in rows:
+            trie.insert(domain, category)
+        return trie
+
+    def _category_id(self, category):
+        cat_id = self._category_ids.get(category)
+        if cat_id is None:
+            cat_id = len(self.categories)
+            self.categories.append(sys.intern(category))
+            self._category_ids[category] = cat_id
+        return cat_id
+
+    def insert(self, domain, category):
+        domain = domain.rstrip(".")
+        if not domain:
+            return
+
+        cat_id = self._category_id(category)
+        labels = domain.split(".")
+        node = self.root
+
+        for label in reversed(labels[1:]):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[sys.intern(label)] = _Node()
+            elif child.__class__ is int:
+                child = node.children[label] = _Node(child)
+            node = child
+
+        if node.children is None:
+            node.children = {}
+        label = labels[0]
+        child = node.children.get(label)
+        if child is None or child.__class__ is int:
+            if child is None:
+                self.size += 1
+            node.children[sys.intern(label)] = cat_id
+        else:
+            if child.category is None:
+                self.size += 1
+            child.category = cat_id
+
+    def longest_match(self, domain):
+        node = self.root
+        best = None
+
+        for label in reversed(domain.rstrip(".").split(".")):
+            children = node.children
+            if children is None:
+                break
+            child = children.get(label)
+            if child is None:
+                break
+            if child.__class__ is int:
+                best = child
+                break
+            if child.category is not None:
+                best = child.category
+            node = child
+
+        return None if best is None else self.categories[best]
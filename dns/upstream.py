@@ -0,0 +1,644 @@
+import asyncio
+import random
+import secrets
+import socket
+import time
+
+from dns.wire import FLAG_TC, HEADER
+
+# Sockets shared by all upstream queries of one process.
+POOL_SIZE = 4
+
+# A pool socket is replaced after this many queries so the source port an
+# off-path attacker has to guess keeps changing.
+SOCKET_MAX_QUERIES = 5000
+
+# Persistent TCP connections per upstream, used when a UDP answer comes
+# back truncated. Queries are pipelined on them (RFC 7766).
+TCP_POOL_SIZE = 2
+
+# Each try waits srtt + 4 * rttvar of its upstream (the RFC 6298 retransmit
+# timer) within these bounds before the next try goes out; the caller's
+# timeout caps the whole query. A server without RTT samples gets the
+# initial value.
+MIN_TRY_TIMEOUT = 0.2
+MAX_TRY_TIMEOUT = 2.0
+INITIAL_TRY_TIMEOUT = 0.8
+
+# Sends per query across the upstream set, the first one included.
+MAX_ATTEMPTS = 3
+
+# The srtt of a server counts half for ranking after this many seconds
+# without a new sample, so one that was slow (or down) gets probed again
+# every few minutes whatever the query rate. The probe's sample replaces
+# the old srtt.
+SRTT_HALF_LIFE = 30.0
+
+# After this many failures in a row a server goes to the back of the line
+# for DOWN_TIME seconds, doubling per further failure up to MAX_DOWN_TIME.
+FAILURE_THRESHOLD = 3
+DOWN_TIME = 2.0
+MAX_DOWN_TIME = 60.0
+
+
+def _matches(response, txid, question):
+    # A reply must carry our random ID and echo our question section;
+    # anything else is a late answer to an abandoned query or a spoof.
+    return (
+        len(response) >= HEADER.size
+        and response[:2] == txid
+        and response[HEADER.size:HEADER.size + len(question)] == question
+    )
+
+
+def _question_bytes(data, question_end):
+    # queries that went through the dnslib fallback are matched on ID only
+    return data[HEADER.size:question_end] if question_end else b""
+
+
+class _PooledSocket(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.pending = {}  # txid bytes -> (future, question bytes)
+        self.sent = 0
+        self.retired = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        waiter = self.pending.get(data[:2])
+        if waiter is None:
+            return
+        future, question = waiter
+        if _matches(data, data[:2], question) and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc):
+        # ICMP errors on a connected socket cannot be tied to one query
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def connection_lost(self, exc):
+        self.retired = True
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(exc or ConnectionError("socket closed"))
+
+    def new_txid(self):
+        while True:
+            txid = secrets.token_bytes(2)
+            if txid not in self.pending:
+                return txid
+
+    def release(self, txid):
+        self.pending.pop(txid, None)
+        if self.retired and not self.pending and self.transport is not None:
+            self.transport.close()
+
+    def retire(self):
+        self.retired = True
+        if not self.pending:
+            self.transport.close()
+
+
+class UpstreamServer:
+    # Health of one upstream: smoothed RTT and variance, failure streak.
+
+    __slots__ = (
+        "address", "srtt", "rttvar", "updated", "samples", "answers",
+        "timeouts", "errors", "failures", "failed_at", "down_until",
+    )
+
+    def __init__(self, address):
+        self.address = address
+        # untried servers sort first, in random order
+        self.srtt = random.uniform(0.0, 0.001)
+        self.rttvar = 0.0
+        self.updated = 0.0
+        self.samples = 0
+        self.answers = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.failures = 0
+        self.failed_at = 0.0
+        self.down_until = 0.0
+
+    def try_timeout(self):
+        if not self.samples:
+            return INITIAL_TRY_TIMEOUT
+        timeout = self.srtt + 4 * self.rttvar
+        return min(MAX_TRY_TIMEOUT, max(MIN_TRY_TIMEOUT, timeout))
+
+    def score(self, now):
+        # srtt as used for ranking, decayed while the server goes unused
+        return self.srtt * 0.5 ** ((now - self.updated) / SRTT_HALF_LIFE)
+
+    def record_answer(self, now, rtt):
+        # a sample after a failure or a long gap replaces the old srtt
+        if (
+            self.samples
+            and not self.failures
+            and now - self.updated < SRTT_HALF_LIFE
+        ):
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        else:
+            self.srtt = rtt
+            if not self.samples:
+                self.rttvar = rtt / 2
+        self.updated = now
+        self.samples += 1
+        self.answers += 1
+        self.failures = 0
+        self.down_until = 0.0
+
+    def record_timeout(self, now, sent):
+        # back off like a retransmit timer: srtt doubles, at least to the
+        # time we gave up after
+        self.timeouts += 1
+        if self._failed(now, sent):
+            self.srtt = min(MAX_TRY_TIMEOUT, max(self.srtt * 2, now - sent))
+
+    def record_slower(self, now, elapsed):
+        # lost a race: no RTT sample, but it took longer than `elapsed`
+        self.srtt = max(self.score(now), elapsed)
+        self.updated = now
+
+    def record_error(self, now, sent):
+        self.errors += 1
+        if self._failed(now, sent):
+            self.srtt = MAX_TRY_TIMEOUT
+
+    def _failed(self, now, sent):
+        # Tries already in flight when the last failure was recorded belong
+        # to the same outage or loss burst; only the first one counts.
+        if sent < self.failed_at:
+            return False
+        self.failed_at = now
+        self.updated = now
+        self.failures += 1
+        if self.failures >= FAILURE_THRESHOLD:
+            backoff = DOWN_TIME * 2 ** (self.failures - FAILURE_THRESHOLD)
+            self.down_until = now + min(backoff, MAX_DOWN_TIME)
+        return True
+
+    def stats(self, now):
+        return {
+            "srtt_ms": self.srtt * 1000,
+            "try_timeout_ms": self.try_timeout() * 1000,
+            "answers": self.answers,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "down": self.down_until > now,
+        }
+
+
+def rank(servers, now):
+    # fastest first, those marked down last
+    return sorted(servers, key=lambda s: (s.down_until > now, s.score(now)))
+
+
+def _stats(servers):
+    now = time.monotonic()
+    return {
+        f"{server.address[0]}:{server.address[1]}": server.stats(now)
+        for server in servers
+    }
+
+
+class UpstreamPool:
+    """A few long-lived UDP sockets shared by every upstream query.
+
+    Outstanding queries are multiplexed by a random transaction ID per
+    socket and answers are matched back on ID plus question section.
+    """
+
+    def __init__(self, server, size=POOL_SIZE):
+        self.server = server
+        self.size = size
+        self.sockets = [None] * size
+        self.queries = 0
+        self.timeouts = 0
+        self._lock = asyncio.Lock()
+
+    async def _socket(self):
+        index = random.randrange(self.size)
+        sock = self.sockets[index]
+        if sock is not None and not sock.retired:
+            return sock
+
+        async with self._lock:
+            sock = self.sockets[index]
+            if sock is None or sock.retired:
+                loop = asyncio.get_running_loop()
+                _, sock = await loop.create_datagram_endpoint(
+                    _PooledSocket,
+                    remote_addr=self.server
+                )
+                self.sockets[index] = sock
+        return sock
+
+    async def query(self, data, question_end, timeout):
+        sock = await self._socket()
+        txid = sock.new_txid()
+        future = asyncio.get_running_loop().create_future()
+        sock.pending[txid] = (future, _question_bytes(data, question_end))
+
+        sock.sent += 1
+        if sock.sent >= SOCKET_MAX_QUERIES:
+            sock.retire()
+
+        self.queries += 1
+        try:
+            sock.transport.sendto(txid + data[2:])
+            response = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            sock.release(txid)
+
+        # hand the answer back under the client's own ID
+        return data[:2] + response[2:]
+
+    def close(self):
+        for sock in self.sockets:
+            if sock is not None and sock.transport is not None:
+                sock.transport.close()
+        self.sockets = [None] * self.size
+
+
+class _TCPConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}  # txid bytes -> (future, question bytes)
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        exc = None
+        try:
+            while True:
+                length = await self.reader.readexactly(2)
+                data = await self.reader.readexactly(
+                    int.from_bytes(length, "big")
+                )
+                waiter = self.pending.get(data[:2])
+                if waiter is None:
+                    continue
+                future, question = waiter
+                if _matches(data, data[:2], question) and not future.done():
+                    future.set_result(data)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            exc = e
+        finally:
+            # the upstream closed it (idle timeout) or the pool is closing
+            self.close()
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError(f"TCP connection lost: {exc!r}")
+                    )
+
+    def new_txid(self):
+        while True:
+            txid = secrets.token_bytes(2)
+            if txid not in self.pending:
+                return txid
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+
+
+class TCPUpstreamPool:
+    """Pipelined TCP connections to one upstream, opened on first use.
+
+    Answers may come back in any order and are matched like UDP ones.
+    """
+
+    def __init__(self, server, size=TCP_POOL_SIZE):
+        self.server = server
+        self.size = size
+        self.connections = [None] * size
+        self.queries = 0
+        self.timeouts = 0
+        self.connects = 0
+        self._lock = asyncio.Lock()
+
+    async def _connection(self):
+        # returns (connection, fresh)
+        index = random.randrange(self.size)
+        conn = self.connections[index]
+        if conn is not None and not conn.closed:
+            return conn, False
+
+        async with self._lock:
+            conn = self.connections[index]
+            if conn is not None and not conn.closed:
+                return conn, False
+            reader, writer = await asyncio.open_connection(*self.server)
+            self.connects += 1
+            conn = self.connections[index] = _TCPConnection(reader, writer)
+        return conn, True
+
+    async def _query(self, data, question_end):
+        question = _question_bytes(data, question_end)
+        message = len(data).to_bytes(2, "big") + data
+        while True:
+            conn, fresh = await self._connection()
+            txid = conn.new_txid()
+            future = asyncio.get_running_loop().create_future()
+            conn.pending[txid] = (future, question)
+            try:
+                conn.writer.write(message[:2] + txid + message[4:])
+                response = await future
+            except ConnectionError:
+                # a reused connection may have been closed by the upstream
+                # just now; a fresh one failing is a real error
+                if fresh:
+                    raise
+                continue
+            finally:
+                conn.pending.pop(txid, None)
+            return data[:2] + response[2:]
+
+    async def query(self, data, question_end, timeout):
+        self.queries += 1
+        try:
+            return await asyncio.wait_for(
+                self._query(data, question_end),
+                timeout
+            )
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def close(self):
+        for conn in self.connections:
+            if conn is not None:
+                conn.close()
+                conn.reader_task.cancel()
+        self.connections = [None] * self.size
+
+
+class UpstreamSet:
+    """Sends each query to the fastest healthy upstream, retrying on others.
+
+    A try that is not answered within its server's adaptive timeout is left
+    running while the next one goes out (to the next server in line, or the
+    same one when there is only one), and the first answer from any of them
+    wins. With race=True the first two servers are asked at once.
+    A truncated answer is fetched again from the same server over TCP.
+    """
+
+    def __init__(self, servers, race=False, pool_size=POOL_SIZE,
+                 max_attempts=MAX_ATTEMPTS):
+        self.servers = [UpstreamServer(address) for address in servers]
+        self.pools = {
+            server: UpstreamPool(server.address, pool_size)
+            for server in self.servers
+        }
+        self.tcp_pools = {
+            server: TCPUpstreamPool(server.address)
+            for server in self.servers
+        }
+        self.race = race
+        self.max_attempts = max_attempts
+        self.queries = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.tcp_fallbacks = 0
+
+    async def query(self, data, question_end, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self.queries += 1
+        server, response = await self._query_udp(data, question_end, deadline)
+        if response[2] & FLAG_TC:
+            self.tcp_fallbacks += 1
+            response = await self.tcp_pools[server].query(
+                data,
+                question_end,
+                deadline - loop.time()
+            )
+        return response
+
+    async def _query_udp(self, data, question_end, deadline):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        order = rank(self.servers, start)
+
+        # task -> [server, sent, try deadline, timed out]
+        attempts = {}
+        launched = 0
+
+        def launch():
+            nonlocal launched
+            server = order[launched % len(order)]
+            if launched:
+                self.retries += 1
+            launched += 1
+            sent = loop.time()
+            task = asyncio.ensure_future(
+                self.pools[server].query(data, question_end, deadline - sent)
+            )
+            attempts[task] = [server, sent, sent + server.try_timeout(), False]
+
+        launch()
+        if self.race and len(order) > 1:
+            launch()
+
+        error = None
+        try:
+            while attempts:
+                now = loop.time()
+                if now >= deadline:
+                    break
+                expired = [
+                    attempt for attempt in attempts.values()
+                    if not attempt[3] and attempt[2] <= now
+                ]
+                for attempt in expired:
+                    attempt[3] = True
+                    attempt[0].record_timeout(now, attempt[1])
+                    if launched < self.max_attempts:
+                        launch()
+
+                wake = min(
+                    [attempt[2] for attempt in attempts.values()
+                     if not attempt[3]],
+                    default=deadline
+                )
+                done, _ = await asyncio.wait(
+                    list(attempts),
+                    timeout=max(0.0, min(wake, deadline) - now),
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    server, sent, _, timed_out = attempts.pop(task)
+                    try:
+                        response = task.result()
+                    except (asyncio.TimeoutError, OSError) as e:
+                        error = e
+                        if not timed_out:
+                            server.record_error(loop.time(), sent)
+                        if launched < self.max_attempts:
+                            launch()
+                        continue
+                    # a late answer still corrects the server's srtt
+                    now = loop.time()
+                    server.record_answer(now, now - sent)
+                    return server, response
+        finally:
+            now = loop.time()
+            for task, (server, sent, _, timed_out) in attempts.items():
+                task.cancel()
+                if not timed_out:
+                    server.record_slower(now, now - sent)
+
+        if error is None or loop.time() >= deadline:
+            self.timeouts += 1
+            raise asyncio.TimeoutError()
+        raise error
+
+    def stats(self):
+        return _stats(self.servers)
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        for pool in self.tcp_pools.values():
+            pool.close()
+
+
+class BlockingUpstream:
+    # Same ID/question matching and server selection for the legacy blocking
+    # server, over one persistent socket per upstream. Tries run one after
+    # the other, there is no racing here.
+
+    def __init__(self, servers, max_attempts=MAX_ATTEMPTS):
+        self.servers = [UpstreamServer(address) for address in servers]
+        self.max_attempts = max_attempts
+        self.sockets = {}  # server -> [socket, sent]
+
+    def _socket(self, server):
+        entry = self.sockets.get(server)
+        if entry is None or entry[1] >= SOCKET_MAX_QUERIES:
+            if entry is not None:
+                entry[0].close()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect(server.address)
+            entry = self.sockets[server] = [sock, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _try(self, server, data, question, timeout):
+        sock = self._socket(server)
+        txid = secrets.token_bytes(2)
+        sock.send(txid + data[2:])
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("upstream timed out")
+            sock.settimeout(remaining)
+            response = sock.recv(65535)
+            if _matches(response, txid, question):
+                return data[:2] + response[2:]
+
+    def _try_tcp(self, server, data, question, timeout):
+        # one connection per truncated answer; rare enough in sync mode
+        txid = secrets.token_bytes(2)
+        with socket.create_connection(server.address, timeout) as sock:
+            sock.sendall(len(data).to_bytes(2, "big") + txid + data[2:])
+            sock.settimeout(timeout)
+            reader = sock.makefile("rb")
+            length = int.from_bytes(reader.read(2), "big")
+            response = reader.read(length)
+        if len(response) < length or not _matches(response, txid, question):
+            raise ConnectionError("bad TCP answer from upstream")
+        return data[:2] + response[2:]
+
+    def query(self, data, question_end, timeout):
+        question = _question_bytes(data, question_end)
+        deadline = time.monotonic() + timeout
+        order = rank(self.servers, time.monotonic())
+        error = socket.timeout("upstream timed out")
+        for attempt in range(self.max_attempts):
+            server = order[attempt % len(order)]
+            sent = time.monotonic()
+            remaining = deadline - sent
+            if remaining <= 0:
+                break
+            # the last try may use whatever is left of the budget
+            try_timeout = remaining
+            if attempt < self.max_attempts - 1:
+                try_timeout = min(remaining, server.try_timeout())
+            try:
+                response = self._try(server, data, question, try_timeout)
+            except socket.timeout as e:
+                server.record_timeout(time.monotonic(), sent)
+                error = e
+            except OSError as e:
+                server.record_error(time.monotonic(), sent)
+                error = e
+            else:
+                now = time.monotonic()
+                server.record_answer(now, now - sent)
+                if response[2] & FLAG_TC:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout("upstream timed out")
+                    response = self._try_tcp(server, data, question, remaining)
+                return response
+        raise error
+
+    def stats(self):
+        return _stats(self.servers)
+
+
+class SingleFlight:
+    # Identical cache misses share one upstream query: the first caller for
+    # a key (the leader) resolves it, later callers wait for its answer.
+
+    def __init__(self):
+        self.pending = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(self, key, resolve):
+        """Return (result, leader) where leader tells if this call resolved."""
+        future = self.pending.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future), False
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        self.leaders += 1
+        try:
+            result = await resolve()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # followers re-raise it; don't warn when there were none
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, True
+        finally:
+            del self.pending[key]
+
+    def stats(self):
+        return {
+            "inflight": len(self.pending),
+            "upstream_queries": self.leaders,
+            "coalesced": self.coalesced,
+        }
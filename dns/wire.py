@@ -0,0 +1,211 @@
+import struct
+from collections import namedtuple
+
+# Helpers that work on raw DNS messages (RFC 1035 section 4) so the hot
+# path does not need to build dnslib objects.
+
+HEADER = struct.Struct("!HHHHHH")
+RR_FIXED = struct.Struct("!HHIH")  # type, class, ttl, rdlength
+TTL = struct.Struct("!I")
+
+TYPE_SOA = 6
+TYPE_OPT = 41
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+# Byte 2 of the header: QR, 4 opcode bits, AA, TC, RD
+FLAG_QR = 0x80
+FLAG_OPCODE = 0x78
+FLAG_AA = 0x04
+FLAG_TC = 0x02
+FLAG_RD = 0x01
+# Byte 3: RA, Z, AD, CD, 4 rcode bits
+FLAG_RA = 0x80
+
+MAX_NAME_LENGTH = 255
+
+# UDP payload every client accepts; larger answers need EDNS (RFC 6891)
+# advertising more, or TCP.
+MIN_UDP_PAYLOAD = 512
+
+# Label bytes the fast path accepts; anything else (escapes, dots inside a
+# label, non-ASCII) is left to dnslib so qnames are formatted the same way.
+HOSTNAME_BYTES = (
+    b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_"
+)
+
+# end is the offset just past the question section, None when the query was
+# decoded by dnslib instead of parse_question
+Question = namedtuple("Question", "qname qtype qclass end")
+
+
+def skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length & 0xC0:
+            raise ValueError("unsupported label type")
+        offset += length + 1
+
+
+def parse_question(data):
+    """Decode the single question of a standard query without dnslib.
+
+    Returns a Question with the lowercased, dot-terminated qname, or None
+    for anything unusual (responses, other opcodes, several questions,
+    compressed or escaped names) so the caller can fall back to dnslib.
+    """
+    if len(data) < HEADER.size + 5:
+        return None
+    if data[2] & (FLAG_QR | FLAG_OPCODE) or data[4:6] != b"\x00\x01":
+        return None
+
+    labels = []
+    offset = HEADER.size
+    try:
+        while True:
+            length = data[offset]
+            if length == 0:
+                break
+            if length > 63:
+                return None
+            offset += 1
+            label = data[offset:offset + length]
+            if len(label) != length or label.translate(None, HOSTNAME_BYTES):
+                return None
+            labels.append(label)
+            offset += length
+            if offset - HEADER.size > MAX_NAME_LENGTH:
+                return None
+    except IndexError:
+        return None
+
+    offset += 1
+    if offset + 4 > len(data):
+        return None
+    qtype, qclass = struct.unpack_from("!HH", data, offset)
+    qname = b".".join(labels).lower().decode("ascii") + "."
+
+    return Question(qname, qtype, qclass, offset + 4)
+
+
+def error_response(query, question_end, rcode):
+    # header + echoed question, no records; RD is copied from the query
+    flags = FLAG_QR | FLAG_AA | (query[2] & FLAG_RD)
+    return (
+        query[:2]
+        + bytes((flags, FLAG_RA | rcode))
+        + b"\x00\x01\x00\x00\x00\x00\x00\x00"
+        + query[HEADER.size:question_end]
+    )
+
+
+def scan_ttls(data):
+    """Return (ttl_offsets, ttl, negative) for a response.
+
+    ttl_offsets covers every record except OPT, whose TTL field holds EDNS
+    flags. ttl is the smallest TTL in the answer section; for NXDOMAIN and
+    NODATA answers it is the negative TTL from the authority SOA (the
+    lower of its TTL and MINIMUM, RFC 2308 section 5) and negative is
+    True. ttl is 0 when the response cannot be cached.
+    """
+    try:
+        _, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+        offset = HEADER.size
+        for _ in range(qdcount):
+            offset = skip_name(data, offset) + 4
+
+        ttl_offsets = []
+        answer_ttl = None
+        soa_ttl = None
+        for index in range(ancount + nscount + arcount):
+            offset = skip_name(data, offset)
+            rtype, _, ttl, rdlength = RR_FIXED.unpack_from(data, offset)
+            if rtype != TYPE_OPT:
+                ttl_offsets.append(offset + 4)
+                if index < ancount:
+                    if answer_ttl is None or ttl < answer_ttl:
+                        answer_ttl = ttl
+                elif rtype == TYPE_SOA and index < ancount + nscount:
+                    # MINIMUM is the last field of the SOA rdata
+                    end = offset + RR_FIXED.size + rdlength
+                    minimum = TTL.unpack_from(data, end - 4)[0]
+                    soa_ttl = min(ttl, minimum)
+            offset += RR_FIXED.size + rdlength
+    except (IndexError, struct.error):
+        raise ValueError("truncated DNS message")
+
+    if offset > len(data):
+        raise ValueError("truncated DNS message")
+
+    if answer_ttl is not None:
+        return tuple(ttl_offsets), answer_ttl, False
+
+    rcode = flags & 0x0F
+    if soa_ttl is not None and rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        return tuple(ttl_offsets), soa_ttl, True
+
+    return tuple(ttl_offsets), 0, False
+
+
+def patch_response(data, ttl_offsets, txid, elapsed):
+    # copy the cached message, put the client's ID in and age the TTLs
+    buf = bytearray(data)
+    buf[0:2] = txid
+    if elapsed > 0:
+        for offset in ttl_offsets:
+            ttl = TTL.unpack_from(data, offset)[0]
+            TTL.pack_into(buf, offset, ttl - elapsed if ttl > elapsed else 0)
+    return buf
+
+
+def restamp_response(data, ttl_offsets, txid, ttl):
+    # like patch_response, but every record gets the same TTL
+    buf = bytearray(data)
+    buf[0:2] = txid
+    for offset in ttl_offsets:
+        TTL.pack_into(buf, offset, ttl)
+    return buf
+
+
+def udp_payload_size(query):
+    # the UDP payload size a query advertises in the class field of its
+    # EDNS OPT record (RFC 6891 section 6.2.3), 512 without one
+    try:
+        _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(query)
+        if not arcount:
+            return MIN_UDP_PAYLOAD
+        offset = HEADER.size
+        for _ in range(qdcount):
+            offset = skip_name(query, offset) + 4
+        for _ in range(ancount + nscount + arcount):
+            offset = skip_name(query, offset)
+            rtype, rclass, _, rdlength = RR_FIXED.unpack_from(query, offset)
+            if rtype == TYPE_OPT:
+                return max(rclass, MIN_UDP_PAYLOAD)
+            offset += RR_FIXED.size + rdlength
+    except (IndexError, ValueError, struct.error):
+        pass
+    return MIN_UDP_PAYLOAD
+
+
+def truncate_response(response):
+    # header and question only, with TC set, so the client retries the
+    # query over TCP (RFC 7766 section 5)
+    if response[4:6] == b"\x00\x01":
+        end = skip_name(response, HEADER.size) + 4
+        counts = b"\x00\x01\x00\x00\x00\x00\x00\x00"
+    else:
+        end = HEADER.size
+        counts = b"\x00\x00\x00\x00\x00\x00\x00\x00"
+    return (
+        response[:2]
+        + bytes((response[2] | FLAG_TC, response[3]))
+        + counts
+        + response[HEADER.size:end]
+    )
@@ -1,4 +1,288 @@
-from dns.server import run_dns_server
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from dns.cache import MAX_BYTES, MAX_ENTRIES, STALE_WINDOW
+from dns.metrics import METRICS_HOST, METRICS_PORT
+from dns.policy import CAT_INDEX_PATH, CAT_PATH, DB_PATH
+from dns.ratelimit import (
+    RATE_LIMIT_ACTIONS,
+    RATE_LIMIT_V4_PREFIX,
+    RATE_LIMIT_V6_PREFIX,
+)
+from dns.server import (
+    LISTEN_ADDR,
+    MAX_INFLIGHT,
+    PREFETCH_RATE,
+    UPSTREAM_SERVERS,
+    configure_cache,
+    configure_logging,
+    configure_network,
+    configure_policy,
+    configure_profiling,
+    configure_rate_limit,
+    load_policy,
+    run_async_dns_server,
+    run_dns_server,
+    start_metrics,
+)
+
+# Pause before respawning a crashed worker so a worker that dies on startup
+# does not turn the supervisor into a fork loop.
+RESTART_DELAY = 1.0
+
+
+def address(value):
+    # "host:port", "host" (port 53) or "[v6 address]:port"
+    host, sep, port = value.rpartition(":")
+    if not sep or host.count(":") and not host.endswith("]"):
+        host, port = value, "53"
+    try:
+        return host.strip("[]"), int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid address {value!r}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DNS filtering proxy")
+    parser.add_argument(
+        "--listen",
+        type=address,
+        default=LISTEN_ADDR,
+        help="address to serve DNS on, host[:port]"
+    )
+    parser.add_argument(
+        "--upstream",
+        type=address,
+        action="append",
+        help="resolver that answers allowed queries, host[:port]; repeat "
+             "for several, the fastest healthy one is used"
+    )
+    parser.add_argument(
+        "--upstream-race",
+        action="store_true",
+        help="send each miss to the two fastest upstreams, first answer wins"
+    )
+    parser.add_argument("--policy-db", default=DB_PATH)
+    parser.add_argument("--category-db", default=CAT_PATH)
+    parser.add_argument(
+        "--category-index",
+        default=CAT_INDEX_PATH,
+        help="memory-mapped category index, used when newer than "
+             "--category-db"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("async", "sync"),
+        default="async",
+        help="asyncio pipeline (default) or the legacy blocking loop"
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=MAX_INFLIGHT,
+        help="queries the asyncio server handles concurrently"
+    )
+    parser.add_argument(
+        "--prefetch-rate",
+        type=float,
+        default=PREFETCH_RATE,
+        help="background refreshes of hot cache entries per second, 0 disables"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="worker processes sharing LISTEN_ADDR through SO_REUSEPORT"
+    )
+    parser.add_argument(
+        "--cache-entries",
+        type=int,
+        default=MAX_ENTRIES,
+        help="maximum number of cached responses per process"
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=float,
+        default=MAX_BYTES / (1024 * 1024),
+        help="approximate memory budget of the response cache per process"
+    )
+    parser.add_argument(
+        "--stale-window",
+        type=int,
+        default=STALE_WINDOW,
+        help="seconds expired answers may be served while the upstream is "
+             "slow or down, 0 disables serve-stale"
+    )
+    parser.add_argument(
+        "--log-sample-rate",
+        type=float,
+        default=1.0,
+        help="fraction of queries written to the query log"
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=("json", "binary"),
+        default="json",
+        help="JSON lines in logs/dns.log or compact records in logs/dns.bin"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="queries per second allowed per client (address or subnet), "
+             "0 disables limiting"
+    )
+    parser.add_argument(
+        "--rate-limit-burst",
+        type=float,
+        help="queries a client may send at once, default twice the rate"
+    )
+    parser.add_argument(
+        "--rate-limit-action",
+        choices=RATE_LIMIT_ACTIONS,
+        default="drop",
+        help="what over-limit queries get; truncate answers with TC set "
+             "(REFUSED over TCP)"
+    )
+    parser.add_argument(
+        "--rate-limit-v4-prefix",
+        type=int,
+        default=RATE_LIMIT_V4_PREFIX,
+        metavar="BITS",
+        help="IPv4 clients in the same subnet of this size share a limit"
+    )
+    parser.add_argument(
+        "--rate-limit-v6-prefix",
+        type=int,
+        default=RATE_LIMIT_V6_PREFIX,
+        metavar="BITS",
+        help="IPv6 clients in the same subnet of this size share a limit"
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default=METRICS_HOST,
+        help="address of the Prometheus /metrics endpoint"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="port of the /metrics endpoint (worker N uses port + N), "
+             "0 disables it"
+    )
+    parser.add_argument(
+        "--profile-stages",
+        action="store_true",
+        help="time each hot-path stage of the asyncio server; exported on "
+             "/metrics and printed on SIGUSR1"
+    )
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers needs SO_REUSEPORT, not available here")
+    if not 1 <= args.rate_limit_v4_prefix <= 32:
+        parser.error("--rate-limit-v4-prefix must be between 1 and 32")
+    if not 1 <= args.rate_limit_v6_prefix <= 128:
+        parser.error("--rate-limit-v6-prefix must be between 1 and 128")
+
+    return args
+
+
+def serve(args, reuse_port=False, worker=0):
+    if args.metrics_port:
+        start_metrics(args.metrics_host, args.metrics_port + worker)
+
+    if args.mode == "sync":
+        run_dns_server(reuse_port=reuse_port)
+    else:
+        run_async_dns_server(
+            max_inflight=args.max_inflight,
+            reuse_port=reuse_port,
+            prefetch_rate=args.prefetch_rate
+        )
+
+
+def run_workers(args):
+    # Each worker keeps its own DNSCache. SO_REUSEPORT hashes the client
+    # address/port, so a hot name costs one upstream miss per worker and is
+    # then served locally; nothing is locked or copied between processes.
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                serve(args, reuse_port=True, worker=index)
+            except Exception:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        children[pid] = index
+        print(f"[+] Worker {index} started (pid {pid})", flush=True)
+
+    def shutdown(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    for index in range(args.workers):
+        spawn(index)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        print(
+            f"[!] Worker {index} (pid {pid}) exited with status {status}, "
+            f"restarting",
+            flush=True
+        )
+        time.sleep(RESTART_DELAY)
+        spawn(index)
+
 
 if __name__ == "__main__":
-    run_dns_server()
+    args = parse_args()
+    configure_network(
+        args.listen,
+        args.upstream or UPSTREAM_SERVERS,
+        args.upstream_race
+    )
+    configure_policy(args.policy_db, args.category_db, args.category_index)
+    configure_cache(
+        args.cache_entries,
+        int(args.cache_mb * 1024 * 1024),
+        args.stale_window
+    )
+    configure_logging(args.log_sample_rate, args.log_format)
+    configure_profiling(args.profile_stages)
+    configure_rate_limit(
+        args.rate_limit,
+        args.rate_limit_burst,
+        args.rate_limit_action,
+        args.rate_limit_v4_prefix,
+        args.rate_limit_v6_prefix
+    )
+
+    if args.workers > 1:
+        # load the policy snapshot once so forked workers share its pages
+        load_policy()
+        run_workers(args)
+    else:
+        serve(args)
@@ -0,0 +1,589 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import selectors
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from dns.binlog import MAGIC, read_binary_log  # noqa: E402
+from dns.wire import HEADER, skip_name  # noqa: E402
+
+# Starts main.py against an in-process stub upstream, replays query mixes
+# with a pool of closed-loop clients and writes the results as JSON, e.g.
+#
+#   python scripts/bench.py --output bench/$(git rev-parse --short HEAD).json
+#   python scripts/bench.py --compare bench/old.json --output bench/new.json
+
+WORKLOADS = ("zipf", "nxflood", "blocked", "mixed")
+
+QTYPES = {"A": 1, "NS": 2, "CNAME": 5, "SOA": 6, "PTR": 12, "MX": 15,
+          "TXT": 16, "AAAA": 28, "SRV": 33, "HTTPS": 65}
+
+ANSWER = struct.Struct("!HHHIH")
+
+
+class StubUpstream:
+    # Answers every query with one A record after a fixed delay, ignoring a
+    # random `loss` fraction of them. Replies are built by patching the query
+    # bytes, so the stub stays far cheaper than the proxy it feeds.
+
+    def __init__(self, delay=0.0, ttl=300, address=("127.0.0.1", 0), loss=0.0):
+        self.delay = delay
+        self.ttl = ttl
+        self.loss = loss
+        self.queries = 0
+        self.dropped = 0
+        self._rng = random.Random()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.address = self.sock.getsockname()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def answer(self, query):
+        end = skip_name(query, HEADER.size) + 4
+        flags = struct.unpack_from("!H", query, 2)[0]
+        header = struct.pack(
+            "!HHHHHH", struct.unpack_from("!H", query)[0],
+            0x8180 | (flags & 0x0100), 1, 1, 0, 0
+        )
+        rr = ANSWER.pack(0xC00C, 1, 1, self.ttl, 4) + bytes((192, 0, 2, 1))
+        return header + query[HEADER.size:end] + rr
+
+    def _run(self):
+        due = []
+        while not self._stop:
+            timeout = 0.1
+            if due:
+                timeout = max(0.0, due[0][0] - time.monotonic())
+            self.sock.settimeout(timeout)
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except (socket.timeout, BlockingIOError):
+                pass
+            except OSError:
+                return  # closed
+            else:
+                self.queries += 1
+                if self.loss and self._rng.random() < self.loss:
+                    self.dropped += 1
+                    continue
+                try:
+                    reply = self.answer(data)
+                except (IndexError, struct.error):
+                    continue
+                if self.delay:
+                    heapq.heappush(
+                        due, (time.monotonic() + self.delay, id(reply),
+                              reply, addr)
+                    )
+                else:
+                    self.sock.sendto(reply, addr)
+
+            now = time.monotonic()
+            while due and due[0][0] <= now:
+                _, _, reply, addr = heapq.heappop(due)
+                self.sock.sendto(reply, addr)
+
+    def close(self):
+        self._stop = True
+        self._thread.join()
+        self.sock.close()
+
+
+def encode_query(txid, name, qtype):
+    qname = b"".join(
+        bytes((len(label),)) + label
+        for label in name.rstrip(".").encode().split(b".") if label
+    ) + b"\0"
+    return (
+        struct.pack("!HHHHHH", txid, 0x0100, 1, 0, 0, 0)
+        + qname + struct.pack("!HH", qtype, 1)
+    )
+
+
+def run_client(address, queries, concurrency, timeout, results):
+    # Keeps `concurrency` queries outstanding on one socket and records the
+    # latency of each answer in microseconds.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sock.connect(address)
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+
+    latencies = []
+    rcodes = {}
+    lost = 0
+    pending = {}  # txid -> send time
+    free = list(range(65536))
+    random.shuffle(free)
+    position = 0
+
+    while position < len(queries) or pending:
+        while position < len(queries) and len(pending) < concurrency:
+            txid = free.pop()
+            name, qtype = queries[position]
+            position += 1
+            pending[txid] = time.perf_counter()
+            try:
+                sock.send(encode_query(txid, name, qtype))
+            except BlockingIOError:
+                pass  # counted as lost below
+
+        now = time.perf_counter()
+        oldest = min(pending.values()) if pending else now
+        for _ in selector.select(max(0.0, oldest + timeout - now)):
+            while True:
+                try:
+                    data = sock.recv(65535)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break
+                txid = struct.unpack_from("!H", data)[0]
+                sent = pending.pop(txid, None)
+                if sent is None:
+                    continue
+                latencies.append((time.perf_counter() - sent) * 1e6)
+                rcode = data[3] & 0x0F
+                rcodes[rcode] = rcodes.get(rcode, 0) + 1
+                free.append(txid)
+
+        now = time.perf_counter()
+        for txid, sent in list(pending.items()):
+            if now - sent >= timeout:
+                del pending[txid]
+                free.append(txid)
+                lost += 1
+
+    sock.close()
+    results.put((latencies, rcodes, lost))
+
+
+def zipf_names(count, s, size, rng):
+    weights = [1 / (rank ** s) for rank in range(1, count + 1)]
+    names = [f"www.site{rank}.example." for rank in range(count)]
+    return rng.choices(names, weights=weights, k=size)
+
+
+def make_queries(workload, args, rng, blocked, replay=None):
+    n = args.queries
+    if workload == "zipf":
+        return [(name, 1) for name in zipf_names(args.names, args.zipf_s, n, rng)]
+    if workload == "nxflood":
+        # random-subdomain ("water torture") traffic: every query misses
+        return [(f"{rng.getrandbits(48):012x}.victim.example.", 1)
+                for _ in range(n)]
+    if workload == "blocked":
+        return [(f"ads.{rng.choice(blocked)}.", 1) for _ in range(n)]
+    if workload == "mixed":
+        popular = zipf_names(args.names, args.zipf_s, n, rng)
+        queries = []
+        for i in range(n):
+            roll = rng.random()
+            if roll < 0.1:
+                queries.append((f"{rng.choice(blocked)}.", 1))
+            elif roll < 0.2:
+                queries.append(
+                    (f"{rng.getrandbits(48):012x}.victim.example.", 1)
+                )
+            else:
+                queries.append((popular[i], 28 if roll > 0.8 else 1))
+        return queries
+    if workload == "replay":
+        if len(replay) >= n:
+            return replay[:n]
+        return [replay[i % len(replay)] for i in range(n)]
+    raise ValueError(workload)
+
+
+def read_replay(path):
+    # dns.log / dns*.bin from the proxy, or any JSON lines with a
+    # domain/qname/name field and an optional qtype
+    with open(path, "rb") as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    queries = []
+    if binary:
+        for event in read_binary_log(path):
+            if event.domain:
+                queries.append((event.domain, QTYPES.get(event.qtype, 1)))
+        return queries
+
+    with open(path) as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(event, dict):
+                continue
+            name = event.get("domain") or event.get("qname") or event.get("name")
+            if not name:
+                continue
+            qtype = event.get("qtype", "A")
+            if not isinstance(qtype, int):
+                qtype = QTYPES.get(str(qtype).upper(), 1)
+            queries.append((name, qtype))
+    return queries
+
+
+def make_databases(directory, blocked):
+    policy_db = directory / "policy.db"
+    category_db = directory / "category.db"
+
+    conn = sqlite3.connect(policy_db)
+    conn.executescript((ROOT / "db" / "init.sql").read_text())
+    conn.execute("INSERT INTO policies VALUES ('default', 'ads', 0)")
+    conn.commit()
+    conn.close()
+
+    conn = sqlite3.connect(category_db)
+    conn.executescript((ROOT / "category_db" / "init.sql").read_text())
+    conn.executemany(
+        "INSERT OR IGNORE INTO domains (domain, category) VALUES (?, 'ads')",
+        ((domain,) for domain in blocked)
+    )
+    conn.commit()
+    conn.close()
+    return policy_db, category_db
+
+
+def free_port(kind=socket.SOCK_DGRAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_tree(pid):
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def cpu_seconds(pid):
+    # user + system time of the proxy and its worker processes
+    total = 0
+    for child in process_tree(pid):
+        try:
+            with open(f"/proc/{child}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def scrape(ports):
+    # sums the cache counters over every worker's /metrics endpoint
+    totals = {"hits": 0, "misses": 0}
+    pattern = re.compile(r"^dns_proxy_cache_(hits|misses) (\S+)$", re.M)
+    for port in ports:
+        try:
+            with urllib.request.urlopen(
+                f"http://127.0.0.1:{port}/metrics", timeout=2
+            ) as response:
+                body = response.read().decode()
+        except OSError:
+            return None
+        for key, value in pattern.findall(body):
+            totals[key] += float(value)
+    return totals
+
+
+def wait_ready(address, proc, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"proxy exited with status {proc.returncode}")
+            sock.sendto(encode_query(1, "ready.example.", 1), address)
+            try:
+                sock.recvfrom(4096)
+                return
+            except OSError:
+                continue
+    raise RuntimeError("proxy did not answer within %.0fs" % timeout)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))
+    return round(sorted_values[index] / 1000, 3)
+
+
+def run_workload(name, queries, args, address, proc, stubs, metrics_ports):
+    chunks = [queries[i::args.clients] for i in range(args.clients)]
+    results = multiprocessing.Queue()
+    clients = [
+        multiprocessing.Process(
+            target=run_client,
+            args=(address, chunk, args.concurrency, args.timeout, results)
+        )
+        for chunk in chunks
+    ]
+
+    before = scrape(metrics_ports)
+    upstream_before = sum(stub.queries for stub in stubs)
+    cpu_before = cpu_seconds(proc.pid)
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    collected = [results.get() for _ in clients]
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.join()
+    cpu = cpu_seconds(proc.pid) - cpu_before
+    after = scrape(metrics_ports)
+
+    latencies = sorted(v for result in collected for v in result[0])
+    rcodes = {}
+    for result in collected:
+        for rcode, count in result[1].items():
+            rcodes[rcode] = rcodes.get(rcode, 0) + count
+    lost = sum(result[2] for result in collected)
+    answered = len(latencies)
+
+    hit_rate = None
+    if before and after:
+        hits = after["hits"] - before["hits"]
+        lookups = hits + after["misses"] - before["misses"]
+        hit_rate = round(hits / lookups, 4) if lookups else None
+
+    return {
+        "workload": name,
+        "queries": len(queries),
+        "answered": answered,
+        "lost": lost,
+        "seconds": round(elapsed, 3),
+        "qps": round(answered / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": percentile(latencies, 100),
+        },
+        "rcodes": {
+            {0: "NOERROR", 2: "SERVFAIL", 3: "NXDOMAIN", 5: "REFUSED"}.get(
+                rcode, str(rcode)
+            ): count
+            for rcode, count in sorted(rcodes.items())
+        },
+        "cache_hit_rate": hit_rate,
+        "upstream_queries": sum(stub.queries for stub in stubs)
+        - upstream_before,
+        "cpu_us_per_query": (
+            round(cpu / answered * 1e6, 1) if answered else None
+        ),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    previous = {run["workload"]: run for run in old.get("runs", [])}
+    print(f"\nvs {old.get('revision')} ({old.get('started_at')}):")
+    for run in new["runs"]:
+        base = previous.get(run["workload"])
+        if base is None:
+            continue
+        parts = []
+        for label, a, b in (
+            ("qps", base["qps"], run["qps"]),
+            ("p50", base["latency_ms"]["p50"], run["latency_ms"]["p50"]),
+            ("p99", base["latency_ms"]["p99"], run["latency_ms"]["p99"]),
+            ("cpu/q", base["cpu_us_per_query"], run["cpu_us_per_query"]),
+        ):
+            if a and b:
+                parts.append(f"{label} {b / a - 1:+.1%}")
+        print(f"  {run['workload']:<10} " + "  ".join(parts))
+
+
+def stub_spec(value):
+    delay, _, loss = value.partition(":")
+    try:
+        return float(delay), float(loss or 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid stub {value!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-test main.py against a local stub upstream"
+    )
+    parser.add_argument(
+        "--workload",
+        action="append",
+        choices=WORKLOADS + ("replay",),
+        help=f"query mix to run, repeatable (default: {', '.join(WORKLOADS)}"
+             f", plus replay with --replay)"
+    )
+    parser.add_argument(
+        "--replay",
+        help="dns.log, dns*.bin or JSON lines with domain/qname fields"
+    )
+    parser.add_argument("--queries", type=int, default=20_000,
+                        help="queries per workload")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="outstanding queries per client process")
+    parser.add_argument("--clients", type=int, default=2,
+                        help="load generator processes")
+    parser.add_argument("--timeout", type=float, default=2.0,
+                        help="seconds before a query counts as lost")
+    parser.add_argument("--names", type=int, default=10_000,
+                        help="distinct names in the Zipf mixes")
+    parser.add_argument("--zipf-s", type=float, default=1.1)
+    parser.add_argument("--blocked", type=int, default=1_000,
+                        help="domains in the blocked category")
+    parser.add_argument("--stub-delay-ms", type=float, default=5.0,
+                        help="stub upstream answer delay")
+    parser.add_argument("--stub-loss", type=float, default=0.0,
+                        help="fraction of queries the stub ignores")
+    parser.add_argument(
+        "--stub",
+        action="append",
+        type=stub_spec,
+        help="run one stub upstream per DELAY_MS[:LOSS], repeatable; "
+             "replaces --stub-delay-ms/--stub-loss"
+    )
+    parser.add_argument("--stub-ttl", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON here")
+    parser.add_argument("--compare", help="earlier --output to diff against")
+    parser.add_argument(
+        "proxy_args",
+        nargs=argparse.REMAINDER,
+        help="extra main.py flags after --, e.g. -- --mode sync --workers 2"
+    )
+    args = parser.parse_args()
+
+    proxy_args = [a for a in args.proxy_args if a != "--"]
+    workloads = args.workload or list(WORKLOADS) + (
+        ["replay"] if args.replay else []
+    )
+    replay = None
+    if "replay" in workloads:
+        if not args.replay:
+            parser.error("the replay workload needs --replay FILE")
+        replay = read_replay(args.replay)
+        if not replay:
+            parser.error(f"no queries found in {args.replay}")
+
+    rng = random.Random(args.seed)
+    blocked = [f"blocked{i}.example" for i in range(args.blocked)]
+    workers = 1
+    if "--workers" in proxy_args:
+        workers = int(proxy_args[proxy_args.index("--workers") + 1])
+
+    with tempfile.TemporaryDirectory(prefix="dns-bench-") as tmp:
+        directory = Path(tmp)
+        policy_db, category_db = make_databases(directory, blocked)
+        stubs = [
+            StubUpstream(delay / 1000, args.stub_ttl, loss=loss)
+            for delay, loss in args.stub or [(args.stub_delay_ms,
+                                              args.stub_loss)]
+        ]
+        listen = ("127.0.0.1", free_port())
+        metrics_port = free_port(socket.SOCK_STREAM)
+
+        command = [
+            sys.executable, str(ROOT / "main.py"),
+            "--listen", f"{listen[0]}:{listen[1]}",
+            "--policy-db", str(policy_db),
+            "--category-db", str(category_db),
+            "--category-index", str(directory / "category.idx"),
+            "--metrics-port", str(metrics_port),
+        ] + [
+            arg for stub in stubs
+            for arg in ("--upstream", f"{stub.address[0]}:{stub.address[1]}")
+        ] + proxy_args
+        proc = subprocess.Popen(
+            command, cwd=directory,
+            stdout=subprocess.DEVNULL
+        )
+        try:
+            wait_ready(listen, proc)
+            metrics_ports = [metrics_port + i for i in range(workers)]
+            runs = []
+            for workload in workloads:
+                queries = make_queries(workload, args, rng, blocked, replay)
+                run = run_workload(
+                    workload, queries, args, listen, proc, stubs, metrics_ports
+                )
+                runs.append(run)
+                latency = run["latency_ms"]
+                print(
+                    f"{workload:<10} {run['qps']:>9,.0f} qps  "
+                    f"p50 {latency['p50']} ms  p95 {latency['p95']} ms  "
+                    f"p99 {latency['p99']} ms  hit {run['cache_hit_rate']}  "
+                    f"cpu {run['cpu_us_per_query']} us/q  lost {run['lost']}",
+                    flush=True
+                )
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+            for stub in stubs:
+                stub.close()
+
+    result = {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "proxy_args": proxy_args,
+        "settings": {
+            key: getattr(args, key)
+            for key in ("queries", "concurrency", "clients", "timeout",
+                        "names", "zipf_s", "blocked", "stub_delay_ms",
+                        "stub_loss", "stub", "stub_ttl", "seed", "replay")
+        },
+        "runs": runs,
+    }
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dns.bloom import FP_RATE  # noqa: E402
+from dns.catindex import CategoryIndex, build_index  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Compile the category.db domains table into the "
+                "memory-mapped index the proxy loads at startup"
+)
+parser.add_argument("--db", default="category_db/category.db")
+parser.add_argument("--index", default="category_db/category.idx")
+parser.add_argument(
+    "--fp-rate",
+    type=float,
+    default=FP_RATE,
+    help="false-positive rate of the uncategorized pre-check filter; "
+         "0 leaves the filter out"
+)
+args = parser.parse_args()
+
+start = time.perf_counter()
+count = build_index(args.db, args.index, args.fp_rate)
+print(
+    f"[+] {count} domains written to {args.index} "
+    f"in {time.perf_counter() - start:.2f}s"
+)
+
+bloom = CategoryIndex(args.index).filter
+if bloom is not None:
+    stats = bloom.stats()
+    print(
+        f"[+] filter: {stats['bytes'] / 1024:.0f} KiB, "
+        f"{stats['hashes']} hashes, {stats['fp_rate']:.2%} false positives"
+    )
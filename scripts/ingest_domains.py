@@ -1,4 +1,14 @@
+import argparse
+import gzip
+import re
 import sqlite3
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dns.catindex import build_index, index_is_current  # noqa: E402
 
 # SOCIAL_MEDIA_DOMAINS = [
 #     "facebook.com",
@@ -23,16 +33,226 @@ social_media = [
     "truthsocial.com",
 ]
 
-conn = sqlite3.connect("category_db/category.db")
-cur = conn.cursor()
+CAT_DB = "category_db/category.db"
+BATCH_SIZE = 50_000
+
+# Names that show up in hosts files but are not blocklist entries.
+HOSTS_IGNORE = {
+    "localhost", "localhost.localdomain", "local", "broadcasthost",
+    "ip6-localhost", "ip6-loopback", "ip6-localnet", "ip6-mcastprefix",
+    "ip6-allnodes", "ip6-allrouters", "ip6-allhosts", "0.0.0.0",
+}
+
+LABEL = re.compile(r"^(?!-)[a-z0-9_-]{1,63}(?<!-)$")
+ADBLOCK_RULE = re.compile(r"^\|\|([^/^$*|]+)\^(?:\$.*)?$")
+
+
+def read_lines(path):
+    if path == "-":
+        yield from sys.stdin
+        return
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+        yield from f
+
+
+def detect_format(line):
+    if line.startswith(("||", "!", "[Adblock")):
+        return "adblock"
+    if len(line.split()) >= 2:
+        return "hosts"
+    return "plain"
+
+
+def parse_domains(lines, fmt="auto"):
+    # yields raw domain candidates from hosts, AdBlock or plain lists
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in "#!" or line.startswith("@@"):
+            continue
+
+        kind = detect_format(line) if fmt == "auto" else fmt
+        if kind != "adblock":
+            # drop the inline comment before telling the format, or
+            # "name # note" would pass for a hosts line
+            line = line.split("#", 1)[0].strip()
+            if fmt == "auto":
+                kind = detect_format(line)
+
+        if kind == "adblock":
+            match = ADBLOCK_RULE.match(line)
+            if match:
+                yield match.group(1)
+        elif kind == "hosts":
+            for name in line.split()[1:]:
+                if name.lower() not in HOSTS_IGNORE:
+                    yield name
+        else:
+            yield line
+
+
+def normalize(domain):
+    domain = domain.strip().rstrip(".").lower()
+    if domain.startswith("*."):
+        domain = domain[2:]
+    if not domain:
+        return None
+    if not domain.isascii():
+        try:
+            domain = domain.encode("idna").decode("ascii")
+        except UnicodeError:
+            return None
+
+    labels = domain.split(".")
+    if len(domain) > 253 or len(labels) < 2:
+        return None
+    if not all(LABEL.match(label) for label in labels):
+        return None
+    return domain
+
+
+def collect(paths, fmt):
+    seen = set()
+    parsed = 0
+    for path in paths:
+        for raw in parse_domains(read_lines(path), fmt):
+            parsed += 1
+            domain = normalize(raw)
+            if domain is not None:
+                seen.add(domain)
+    return seen, parsed
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-for domain in social_media:
-    cur.execute(
-        "INSERT OR IGNORE INTO domains (domain, category) VALUES (?, ?)",
-        (domain, "social_media")
+
+def ingest(conn, category, domains, replace=False, batch_size=BATCH_SIZE):
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=OFF")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-262144")  # 256 MiB
+
+    existing = {
+        row[0] for row in cur.execute(
+            "SELECT domain FROM domains WHERE category=?", (category,)
+        )
+    }
+    to_write = domains - existing
+    to_delete = existing - domains if replace else set()
+
+    # --replace moves domains listed under another category to this one;
+    # a plain run leaves them where they are.
+    if replace:
+        insert = (
+            "INSERT INTO domains (domain, category) VALUES (?, ?) "
+            "ON CONFLICT(domain) DO UPDATE SET category=excluded.category"
+        )
+    else:
+        insert = (
+            "INSERT OR IGNORE INTO domains (domain, category) VALUES (?, ?)"
+        )
+
+    written = 0
+    deleted = 0
+    cur.execute("BEGIN")
+    try:
+        for batch in batched(sorted(to_write), batch_size):
+            cur.executemany(insert, ((domain, category) for domain in batch))
+            written += cur.rowcount
+        for batch in batched(sorted(to_delete), batch_size):
+            cur.executemany(
+                "DELETE FROM domains WHERE domain=? AND category=?",
+                ((domain, category) for domain in batch)
+            )
+            deleted += cur.rowcount
+        cur.execute("COMMIT")
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+
+    return written, deleted, len(domains & existing)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load domain blocklists into category.db"
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="hosts, AdBlock (||domain^) or plain domain lists, .gz or - "
+             "for stdin; without files the built-in social_media list is used"
+    )
+    parser.add_argument("--category", default="social_media")
+    parser.add_argument("--db", default=CAT_DB)
+    parser.add_argument(
+        "--format",
+        choices=("auto", "hosts", "adblock", "plain"),
+        default="auto"
     )
+    parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="make the category match the input exactly: remove domains no "
+             "longer listed and take over domains from other categories"
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--index",
+        help="category index rebuilt after the load "
+             "(default: the database path with an .idx suffix)"
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="leave the category index alone"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.files:
+        domains, parsed = collect(args.files, args.format)
+    else:
+        domains = {normalize(domain) for domain in social_media}
+        parsed = len(social_media)
+    parse_time = time.perf_counter() - start
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    try:
+        written, deleted, unchanged = ingest(
+            conn, args.category, domains, args.replace, args.batch_size
+        )
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"[+] {args.category}: {parsed} entries parsed, {len(domains)} unique, "
+        f"{written} written, {deleted} removed, {unchanged} unchanged"
+    )
+    print(
+        f"[+] {elapsed:.2f}s total ({parse_time:.2f}s parsing), "
+        f"{parsed / elapsed if elapsed else 0:,.0f} entries/s"
+    )
+
+    index = args.index or str(Path(args.db).with_suffix(".idx"))
+    if not args.no_index and not index_is_current(index, args.db):
+        start = time.perf_counter()
+        count = build_index(args.db, index)
+        print(
+            f"[+] {count} domains indexed in {index} "
+            f"({time.perf_counter() - start:.2f}s)"
+        )
 
-conn.commit()
-conn.close()
 
-print("[+] Social media domains ingested")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from dns.binlog import summarize  # noqa: E402
+
+parser = argparse.ArgumentParser(
+    description="Aggregate DNS query logs (JSON lines or binary) in one pass"
+)
+parser.add_argument("paths", nargs="+", help="dns.log / dns*.bin files")
+parser.add_argument("--top", type=int, default=10)
+args = parser.parse_args()
+
+print(json.dumps(summarize(args.paths, args.top), indent=2))
@@ -0,0 +1,242 @@
+import argparse
+import json
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from dnslib import QTYPE, RR, A, DNSRecord  # noqa: E402
+
+from dns.cache import DNSCache  # noqa: E402
+from dns.catindex import CategoryIndex, build_index  # noqa: E402
+from dns.logger import DNSLogger  # noqa: E402
+from dns.policy import PolicyEngine  # noqa: E402
+from dns.trie import SuffixTrie  # noqa: E402
+from dns.wire import (  # noqa: E402
+    RCODE_NXDOMAIN,
+    error_response,
+    parse_question,
+    patch_response,
+    scan_ttls,
+)
+
+# Per-operation timings of the hot-path building blocks (parse/pack,
+# DNSCache, PolicyEngine, DNSLogger). Run before and after a change:
+#
+#   python scripts/microbench.py --output micro-base.json
+#   python scripts/microbench.py --compare micro-base.json --max-regression 0.2
+#
+# --compare exits with status 1 when a benchmark got slower than allowed.
+
+
+def make_query(name="www.example.com", qtype="A"):
+    return DNSRecord.question(name, qtype).pack()
+
+
+def make_response(query, answers=4):
+    reply = DNSRecord.parse(query).reply()
+    for i in range(answers):
+        reply.add_answer(RR(reply.q.qname, QTYPE.A, rdata=A(f"192.0.2.{i}"),
+                            ttl=300))
+    return reply.pack()
+
+
+def make_category_db(directory, domains, rng):
+    path = directory / "category.db"
+    conn = sqlite3.connect(path)
+    conn.executescript((ROOT / "category_db" / "init.sql").read_text())
+    conn.executemany(
+        "INSERT OR IGNORE INTO domains (domain, category) VALUES (?, ?)",
+        (
+            (f"d{i}-{rng.getrandbits(32):08x}.{rng.choice(('com', 'net', 'org'))}",
+             rng.choice(("ads", "social_media", "malware")))
+            for i in range(domains)
+        )
+    )
+    conn.commit()
+    conn.close()
+    return path
+
+
+def make_policy_db(directory):
+    path = directory / "policy.db"
+    conn = sqlite3.connect(path)
+    conn.executescript((ROOT / "db" / "init.sql").read_text())
+    conn.executemany(
+        "INSERT INTO clients (ip, client_group) VALUES (?, ?)",
+        [(f"10.{i // 256}.{i % 256}.0/24", f"group{i % 8}")
+         for i in range(2000)]
+    )
+    conn.execute("INSERT INTO policies VALUES ('default', 'ads', 0)")
+    conn.commit()
+    conn.close()
+    return path
+
+
+def benchmarks(directory, domains):
+    rng = random.Random(1)
+    query = make_query()
+    response = make_response(query)
+    offsets, ttl, _ = scan_ttls(response)
+    question = parse_question(query)
+
+    cat_path = make_category_db(directory, domains, rng)
+    policy_path = make_policy_db(directory)
+    index_path = directory / "category.idx"
+    build_index(cat_path, index_path)
+    conn = sqlite3.connect(cat_path)
+    listed = [row[0] for row in conn.execute("SELECT domain FROM domains")]
+    trie = SuffixTrie.from_rows(
+        conn.execute("SELECT domain, category FROM domains")
+    )
+    conn.close()
+    index = CategoryIndex(index_path)
+    unlisted = [f"www.u{rng.getrandbits(40):x}.com." for _ in range(1000)]
+    listed_sub = [f"cdn.{rng.choice(listed)}." for _ in range(1000)]
+
+    memo = PolicyEngine(policy_path, cat_path, None)
+    memo.is_allowed("10.1.2.3", "www.example.com.")
+    engine_trie = PolicyEngine(policy_path, cat_path, None,
+                               decision_cache_size=0)
+    engine_index = PolicyEngine(policy_path, cat_path, index_path,
+                                decision_cache_size=0)
+    engine_trie.current()
+    engine_index.current()
+
+    now = time.time()
+    cache = DNSCache()
+    for i in range(10_000):
+        cache.set((f"n{i}.example.", "A"), response, offsets, ttl, now)
+    hit = cache.get(("n1.example.", "A"), now)
+    keys = [(f"n{i}.example.", "A") for i in range(10_000)]
+
+    logger = DNSLogger(directory / "logs" / "dns.log")
+    event = {"client_ip": "10.1.2.3", "domain": "www.example.com.",
+             "qtype": "A", "category": "uncategorized", "decision": "ALLOW",
+             "cache": "HIT", "latency_ms": 0.12}
+
+    def cycle(items):
+        items = list(items)
+        state = {"i": 0}
+
+        def next_item():
+            state["i"] = (state["i"] + 1) % len(items)
+            return items[state["i"]]
+        return next_item
+
+    next_unlisted = cycle(unlisted)
+    next_listed = cycle(listed_sub)
+    next_key = cycle(keys)
+
+    return [
+        ("wire.parse_question", lambda: parse_question(query)),
+        ("dnslib.parse", lambda: DNSRecord.parse(query)),
+        ("wire.scan_ttls", lambda: scan_ttls(response)),
+        ("wire.patch_response",
+         lambda: patch_response(response, offsets, query[:2], 5)),
+        ("wire.error_response",
+         lambda: error_response(query, question.end, RCODE_NXDOMAIN)),
+        ("dnslib.pack_reply", lambda: DNSRecord.parse(query).reply().pack()),
+        ("cache.get_hit", lambda: cache.get(next_key(), now)),
+        ("cache.get_miss", lambda: cache.get(("absent.", "A"), now)),
+        ("cache.render", lambda: hit.render(query[:2], now)),
+        ("cache.set", lambda: cache.set(next_key(), response, offsets, ttl,
+                                        now)),
+        ("trie.match_unlisted", lambda: trie.longest_match(next_unlisted())),
+        ("trie.match_listed", lambda: trie.longest_match(next_listed())),
+        ("index.match_unlisted",
+         lambda: index.longest_match(next_unlisted())),
+        ("index.match_listed", lambda: index.longest_match(next_listed())),
+        ("filter.may_match_unlisted",
+         lambda: index.filter.may_match_suffix(next_unlisted())),
+        ("policy.client_group",
+         lambda: engine_trie.get_client_group("10.1.2.3")),
+        ("policy.is_allowed_memo",
+         lambda: memo.is_allowed("10.1.2.3", "www.example.com.")),
+        ("policy.is_allowed_trie",
+         lambda: engine_trie.is_allowed("10.1.2.3", next_unlisted())),
+        ("policy.is_allowed_index",
+         lambda: engine_index.is_allowed("10.1.2.3", next_unlisted())),
+        ("logger.log", lambda: logger.log(dict(event))),
+    ], logger
+
+
+def measure(func, repeat, min_time):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(number, int(number * min_time / 0.2))
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmarks of the proxy's hot-path components"
+    )
+    parser.add_argument("--filter", help="only run benchmarks containing this")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timing runs per benchmark, the best one counts")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds per timing run")
+    parser.add_argument("--domains", type=int, default=100_000,
+                        help="size of the generated category table")
+    parser.add_argument("--output", help="write ns/op results as JSON here")
+    parser.add_argument("--compare", help="earlier --output to diff against")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.25,
+        help="with --compare, fail when a benchmark is this much slower"
+    )
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="dns-micro-") as tmp:
+        cases, logger = benchmarks(Path(tmp), args.domains)
+        try:
+            for name, func in cases:
+                if args.filter and args.filter not in name:
+                    continue
+                results[name] = round(
+                    measure(func, args.repeat, args.min_time), 1
+                )
+                print(f"{name:<28}{results[name]:>12,.1f} ns/op", flush=True)
+        finally:
+            logger.close()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "python": sys.version.split()[0],
+                "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                            time.gmtime()),
+                "results": results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = []
+        print()
+        for name, value in results.items():
+            old = baseline.get(name)
+            if not old:
+                continue
+            change = value / old - 1
+            flag = ""
+            if change > args.max_regression:
+                regressions.append(name)
+                flag = "  REGRESSION"
+            print(f"{name:<28}{old:>12,.1f} -> {value:>10,.1f} ns/op "
+                  f"{change:+7.1%}{flag}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()